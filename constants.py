@@ -26,3 +26,4 @@ class column_names:
     COMPONENT='component'
     VAR_TYPE = 'variable_type'
     CLINICAL_SOURCE = 'clinical_source'
+    COLUMN_CODE = 'column_code'
@@ -1,81 +1,320 @@
 import abc
+import hashlib
+import multiprocessing
+import time
 import pandas as pd
 import ast
-from constants import column_names
+from constants import column_names,ALL
 import utils
 import logger
+import storage
+
+_WORKER_MANAGER = None
 
 class ETLManager(object):
 
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self,cleaners,hdf5_fname):
+    def __init__(self,cleaners,hdf5_fname,store=None):
+        """
+        store: ComponentStore for the cleaned components, defaults to an
+            HDF5Store on hdf5_fname. Intermediate steps (save_steps=True)
+            are always saved to hdf5_fname.
+        """
         self.cleaners = cleaners
         self.hdf5_fname = hdf5_fname
+        if store is None: store = storage.HDF5Store(hdf5_fname)
+        self.store = store
+        self.__current_ids = None
 
 
-    def etl(self,components,save_steps=False,overwrite=False):
-        if not overwrite:
-            components = self.get_unloaded_components(components)
-        if len(components) == 0: return None
+    def etl(self,components,save_steps=False,overwrite=False,n_workers=1,chunksize=None):
+        """
+        n_workers: if > 1, components are extracted, transformed and cleaned
+            in a pool of n_workers processes. Writes are still done one
+            component at a time by this process.
+        chunksize: if set, each component is streamed through the pipeline and
+            appended to the store in chunks of about chunksize extracted rows
+
+        Unless overwrite, components that are already loaded are only updated
+        with their new ids and items (see update_component), and rebuilt if
+        their cleaners changed or items were removed.
+        """
+        if (chunksize is not None) and (save_steps or n_workers > 1):
+            raise ValueError('chunked etl can not be combined with save_steps or n_workers > 1')
+        self.__current_ids = None
         all_etl_info = []
+        if not overwrite:
+            stale = self.get_stale_components(components)
+            unloaded = self.get_unloaded_components(components)
+            for component in components:
+                if (component in unloaded) or (component in stale): continue
+                etl_info = self.update_component(component)
+                if etl_info is not None: all_etl_info.append(etl_info)
+            components = [c for c in components if (c in unloaded) or (c in stale)]
+        if len(components) == 0:
+            return pd.DataFrame(all_etl_info) if len(all_etl_info) > 0 else None
 
         logger.log('BEGIN ETL for {} components: {}'.format(len(components),components),new_level=True)
-        for component in components:
-            logger.log('{}: {}/{}'.format(component.upper(),components.index(component)+1,len(components)),new_level=True)
+        if chunksize is not None:
+            for component in components:
+                logger.log('{}: {}/{}'.format(component.upper(),components.index(component)+1,len(components)),new_level=True)
+                all_etl_info.append(self.process_component_chunks(component,chunksize))
+                self.record_load(component)
+                logger.end_log_level()
+            logger.end_log_level()
+            return pd.DataFrame(all_etl_info)
+
+        for component,etl_info,dfs in self.__processed_components(components,save_steps,n_workers):
+
+            logger.log('Save DataFrames...',new_level=True)
+            start = time.time()
+            self.save(component,*dfs)
+            self.record_load(component)
+            etl_info['save_time'] = time.time() - start
+            logger.end_log_level()
+
+            all_etl_info.append(etl_info)
+
+            del dfs
 
+        logger.end_log_level()
+        return pd.DataFrame(all_etl_info)
+
+    def __processed_components(self,components,save_steps,n_workers):
+        if n_workers <= 1:
+            for component in components:
+                logger.log('{}: {}/{}'.format(component.upper(),components.index(component)+1,len(components)),new_level=True)
+                etl_info,dfs = self.process_component(component,save_steps)
+                yield component,etl_info,dfs
+                logger.end_log_level()
+            return
+
+        #workers are forked, so they inherit this manager rather than pickling it
+        global _WORKER_MANAGER
+        _WORKER_MANAGER = self
+        pool = multiprocessing.Pool(n_workers,initializer=_init_worker)
+        try:
+            args = [(component,save_steps) for component in components]
+            for ix,(component,etl_info,dfs) in enumerate(pool.imap_unordered(_etl_worker,args)):
+                logger.log('{}: {}/{}'.format(component.upper(),ix+1,len(components)),new_level=True)
+                yield component,etl_info,dfs
+                logger.end_log_level()
+        finally:
+            pool.terminate()
+            pool.join()
+            _WORKER_MANAGER = None
+
+    def process_component(self,component,save_steps=False,df_extracted=None,refit=True):
+        """
+        Extract, transform and clean one component. Returns its etl info,
+        including per-stage timings, and the dataframes to save. The
+        extracted and transformed dataframes are None unless save_steps.
+        If df_extracted is passed, it is used instead of extracting.
+        refit: if False, the cleaners extend what they learned from earlier
+            calls (see _partial_fit_transform) instead of being fit anew
+        """
+        timings = {}
+
+        if df_extracted is None:
             logger.log('Extract...',new_level=True)
+            start = time.time()
             df_extracted = self.extract(component)
+            timings['extract_time'] = time.time() - start
             logger.end_log_level()
 
-            logger.log('Transform...',new_level=True)
-            df_transformed = self.transform(df_extracted,component)
-            logger.end_log_level()
+        logger.log('Transform...',new_level=True)
+        start = time.time()
+        df_transformed = self.transform(df_extracted,component)
+        timings['transform_time'] = time.time() - start
+        logger.end_log_level()
 
-            logger.log('Clean...',new_level=True)
-            df = self.cleaners.fit_transform(df_transformed.copy())
-            logger.end_log_level()
+        logger.log('Clean...',new_level=True)
+        start = time.time()
+        if refit: df = self.cleaners.fit_transform(df_transformed.copy())
+        else: df = _partial_fit_transform(self.cleaners,df_transformed.copy())
+        timings['clean_time'] = time.time() - start
+        logger.end_log_level()
 
-            logger.log('Save DataFrames...',new_level=True)
-            if save_steps:
-                logger.log('Save EXTRACTED DF: {}'.format(df_extracted.shape))
-                df_extracted.to_hdf(self.hdf5_fname,'{}/{}'.format(component,'extracted'))
+        etl_info = self.get_etl_info(component,df_extracted,df_transformed,df)
+        etl_info = etl_info.append(pd.Series(timings))
 
-                logger.log('Save TRANSFORMED DF: {}'.format(df_transformed.shape))
-                df_transformed.to_hdf(self.hdf5_fname,'{}/{}'.format(component,'transformed'))
+        if not save_steps:
+            del df_extracted,df_transformed
+            df_extracted,df_transformed = None,None
 
-            logger.log('Save FINAL DF: {}'.format(df.shape))
-            utils.deconstruct_and_write(df,self.hdf5_fname,path=component)
+        return etl_info,(df_extracted,df_transformed,df)
+
+    def process_component_chunks(self,component,chunksize):
+        """
+        Extract, transform, clean and append a component one chunk at a time,
+        so only about chunksize extracted rows are in memory at once. Returns
+        the etl info summed across chunks. The cleaners are fit on the first
+        chunk and only extended by later ones, so every chunk is encoded
+        with the one-hot vocabulary of all the chunks before it.
+        """
+        chunk_infos = []
+        written = False
+        chunks = iter(self.extract_chunks(component,chunksize))
+        while True:
+            start = time.time()
+            df_extracted = next(chunks,None)
+            if df_extracted is None: break
+            extract_time = time.time() - start
+
+            logger.log('Chunk {}: {}'.format(len(chunk_infos)+1,df_extracted.shape),new_level=True)
+            etl_info,dfs = self.process_component(component,df_extracted=df_extracted,refit=len(chunk_infos) == 0)
+            etl_info['extract_time'] = extract_time
+            df = dfs[-1]
+            del df_extracted,dfs
+
+            start = time.time()
+            if not df.empty:
+                logger.log('Append FINAL DF: {}'.format(df.shape))
+                self.store.write(df,component,append=written)
+                written = True
+            etl_info['save_time'] = time.time() - start
+            chunk_infos.append(etl_info)
+            del df
             logger.end_log_level()
 
+        #chunks never share ids, so the id counts can be summed too
+        etl_info = _sum_etl_info(component,chunk_infos)
+        etl_info['chunk_count'] = len(chunk_infos)
+        return etl_info
 
+    def update_component(self,component):
+        """
+        Extract, clean and add only what a loaded component is missing: rows
+        for new ids are appended, rows for new items of the loaded ids are
+        merged into the stored component. Returns the etl info, or None if
+        the component is up to date or has no manifest.
+        """
+        manifest = self.store.read_manifest(component)
+        if manifest is None: return None
+
+        loaded_ids = _from_ranges(manifest['id_ranges'])
+        new_ids = sorted(set(self.current_ids()) - set(loaded_ids))
+        items = self.component_items(component)
+        new_items = []
+        if (items is not None) and (manifest['items'] is not None):
+            new_items = sorted(set(items) - set(manifest['items']))
+        if (len(new_ids) == 0) and (len(new_items) == 0): return None
+
+        logger.log('UPDATE {}: {} new ids, {} new items'.format(component.upper(),len(new_ids),len(new_items)),new_level=True)
+        all_etl_info = []
+        if len(new_ids) > 0:
+            logger.log('New ids...',new_level=True)
+            all_etl_info.append(self.__process_delta(component,ALL if items is None else items,new_ids,merge=False))
+            logger.end_log_level()
+        if len(new_items) > 0:
+            logger.log('New items...',new_level=True)
+            all_etl_info.append(self.__process_delta(component,new_items,loaded_ids,merge=True))
+            logger.end_log_level()
+        self.record_load(component)
+        logger.end_log_level()
 
-            etl_info = self.get_etl_info(component,df_extracted,df_transformed,df)
-            all_etl_info.append(etl_info)
+        all_etl_info = [etl_info for etl_info in all_etl_info if etl_info is not None]
+        if len(all_etl_info) == 0: return None
+        return _sum_etl_info(component,all_etl_info)
+
+    def __process_delta(self,component,itemids,ids,merge):
+        start = time.time()
+        df_extracted = self.extract_delta(component,itemids,ids)
+        extract_time = time.time() - start
+        if (df_extracted is None) or df_extracted.empty: return None
+
+        etl_info,dfs = self.process_component(component,df_extracted=df_extracted)
+        etl_info['extract_time'] = extract_time
+        df = dfs[-1]
+        del df_extracted,dfs
+
+        start = time.time()
+        if not df.empty:
+            if merge and df.index.isin(self.store.read(component,ids=_index_ids(df)).index).any():
+                # rows at the index of stored rows have to be merged into them
+                logger.log('Merge FINAL DF: {}'.format(df.shape))
+                self.store.write(_merge_rows(self.store.read(component),df),component)
+            else:
+                # the store lines the rows up with its columns, dummies they lack are 0
+                logger.log('Append FINAL DF: {}'.format(df.shape))
+                self.store.write(df,component,append=True)
+        etl_info['save_time'] = time.time() - start
+        return etl_info
+
+    def get_stale_components(self,components):
+        """
+        Loaded components that can't be updated incrementally, because their
+        cleaners changed or some of their items were removed
+        """
+        stale = []
+        cleaners = _fingerprint(self.cleaners)
+        for component in components:
+            manifest = self.store.read_manifest(component)
+            if manifest is None: continue
+            items = self.component_items(component)
+            removed_items = (items is not None) and (manifest['items'] is not None) and \
+                                len(set(manifest['items']) - set(items)) > 0
+            if (manifest['cleaners'] != cleaners) or removed_items:
+                stale.append(component)
+        return stale
+
+    def record_load(self,component):
+        """
+        Save the manifest of what is now loaded for a component
+        """
+        items = self.component_items(component)
+        self.store.write_manifest(component,{
+            'items' : None if items is None else sorted(int(item) for item in items),
+            'id_ranges' : _to_ranges(self.current_ids()),
+            'cleaners' : _fingerprint(self.cleaners)
+        })
 
-            del df_extracted,df_transformed,df
+    def current_ids(self):
+        #all_ids is only queried once per etl
+        if self.__current_ids is None:
+            self.__current_ids = sorted(int(ID) for ID in self.all_ids())
+        return self.__current_ids
 
-            logger.end_log_level()
+    def component_items(self,component):
+        """
+        The items (e.g. itemids) a component is extracted from, used to find
+        new and removed items. None if items are not tracked.
+        """
+        return None
 
+    def extract_chunks(self,component,chunksize):
+        """
+        Yields the extracted component in chunks of about chunksize rows,
+        never splitting an id across chunks. Defaults to a single chunk.
+        """
+        yield self.extract(component)
 
+    def save(self,component,df_extracted,df_transformed,df):
+        if df_extracted is not None:
+            logger.log('Save EXTRACTED DF: {}'.format(df_extracted.shape))
+            df_extracted.to_hdf(self.hdf5_fname,'{}/{}'.format(component,'extracted'))
 
-        logger.end_log_level()
-        return pd.DataFrame(all_etl_info)
+        if df_transformed is not None:
+            logger.log('Save TRANSFORMED DF: {}'.format(df_transformed.shape))
+            df_transformed.to_hdf(self.hdf5_fname,'{}/{}'.format(component,'transformed'))
 
+        logger.log('Save FINAL DF: {}'.format(df.shape))
+        self.store.write(df,component)
+
+    def init_worker(self):
+        """
+        Called once in every worker process of a parallel etl, before any
+        component is processed, e.g. to open a new database connection.
+        """
+        return
 
     def get_unloaded_components(self,components):
-        store = pd.HDFStore(self.hdf5_fname)
-        unloaded = [c for c in components if c not in store]
-        store.close()
-        return unloaded
+        return [c for c in components if c not in self.store]
 
-    def open_df(self,component,ids=None):
+    def open_df(self,component,ids=None,specs=None):
         #open dataframe, assume in root directory
-        where = None
-        if ids is not None:
-            ids = sorted(list(set(ids)))
-            where = '{} in {}'.format(column_names.ID,ids)
-        return utils.read_and_reconstruct(self.hdf5_fname, path=component, where=where)
+        return self.store.read(component,ids=ids,specs=specs)
 
     def get_etl_info_df(self,components):
         """
@@ -103,7 +342,7 @@ class ETLManager(object):
 
 
         if df_cleaned is None:
-            df_cleaned = utils.read_and_reconstruct(self.hdf5_fname,component)
+            df_cleaned = self.store.read(component)
         c_ids = df_cleaned.index.get_level_values(column_names.ID).unique().tolist()
         c_data_count = df_cleaned.apply(utils.smart_count).sum()
 
@@ -124,6 +363,13 @@ class ETLManager(object):
     def extract(self,componment):
         return
 
+    @abc.abstractmethod
+    def extract_delta(self,component,itemids,ids):
+        """
+        Extract only the given items (or ALL) for the given ids
+        """
+        return
+
     @abc.abstractmethod
     def transform(self,df,component):
         return
@@ -139,3 +385,79 @@ class ETLManager(object):
     @abc.abstractmethod
     def all_ids(self):
         return
+
+
+def _init_worker():
+    _WORKER_MANAGER.init_worker()
+
+def _etl_worker(args):
+    component,save_steps = args
+    etl_info,dfs = _WORKER_MANAGER.process_component(component,save_steps)
+    return component,etl_info,dfs
+
+def _partial_fit_transform(cleaners,df):
+    """
+    fit_transform, except that steps with a partial_fit (e.g. a one-hot
+    encoder) extend what they learned before instead of starting over
+    """
+    steps = [est for _,est in cleaners.steps] if hasattr(cleaners,'steps') else [cleaners]
+    for est in steps:
+        if est is None: continue
+        if hasattr(est,'steps'): df = _partial_fit_transform(est,df)
+        elif hasattr(est,'partial_fit'): df = est.partial_fit(df).transform(df)
+        else: df = est.fit_transform(df)
+    return df
+
+def _sum_etl_info(component,all_etl_info):
+    etl_info = pd.DataFrame(all_etl_info).sum(numeric_only=True)
+    etl_info[column_names.COMPONENT] = component
+    return etl_info
+
+def _fingerprint(estimator):
+    """
+    Hash of an estimator's parameters that is stable across processes:
+    objects are described by their fingerprint() (e.g. a hash of a data
+    dictionary's contents) if they have one, else by their class name.
+    """
+    params = []
+    for name,value in sorted(estimator.get_params(deep=True).items()):
+        if hasattr(value,'fingerprint') and not isinstance(value,type):
+            value = (type(value).__name__,value.fingerprint())
+        elif not isinstance(value,(basestring,int,long,float,bool,type(None))):
+            value = type(value).__name__
+        params.append((name,value))
+    return hashlib.md5(repr(params)).hexdigest()
+
+def _index_ids(df):
+    return df.index.get_level_values(column_names.ID).unique().tolist()
+
+def _merge_rows(df_stored,df):
+    """
+    df_stored with the rows and columns of df added, stored values first.
+    Integer (e.g. dummy) columns are 0 where a frame lacks them, and the
+    larger of the two where both have them, so they keep their dtype.
+    """
+    merged = df_stored.combine_first(df)
+    for col_name in merged.columns:
+        dtypes = [d.dtypes[col_name] for d in (df_stored,df) if col_name in d.columns]
+        if not all(dtype.kind in 'iub' for dtype in dtypes): continue
+        col = pd.concat([d[col_name] for d in (df_stored,df) if col_name in d.columns],axis=1)
+        col = col.reindex(merged.index).fillna(0).max(axis=1)
+        merged[col_name] = col.astype(pd.np.result_type(*dtypes))
+    return merged
+
+def _to_ranges(ids):
+    """
+    sorted ids -> [[first,last],...] of consecutive runs
+    """
+    ranges = []
+    for ID in ids:
+        if (len(ranges) > 0) and (ID == ranges[-1][1] + 1): ranges[-1][1] = ID
+        else: ranges.append([ID,ID])
+    return ranges
+
+def _from_ranges(ranges):
+    ids = []
+    for first,last in ranges:
+        ids += range(first,last+1)
+    return ids
@@ -1,27 +1,82 @@
+import os
+import hashlib
 import pandas as pd
 import utils
 from constants import variable_type,clinical_source,NO_UNITS,column_names
 
+#bump when what the snapshot holds (e.g. the indexes) changes, older snapshots are then rebuilt
+SNAPSHOT_VERSION = 2
+
 class data_dictionary(object):
 
-    def __init__(self,xls_fname):
+    def __init__(self,xls_fname,snapshot_dir=None):
+
+        self.load(xls_fname,snapshot_dir)
 
-        self.load(xls_fname)
+    def load(self,xls_fname,snapshot_dir=None):
+        """
+        snapshot_dir: the parsed tables and lookup indexes are pickled here
+            and loaded instead of the xlsx until its mtime and size, then
+            contents, change. None for the directory of xls_fname, False to
+            always parse the xlsx.
+        """
+        if snapshot_dir is None: snapshot_dir = os.path.dirname(os.path.abspath(xls_fname))
+        snapshot = _read_snapshot(xls_fname,snapshot_dir)
+        if snapshot is None:
+            xls = pd.ExcelFile(xls_fname)
+            df_tables = {sheet_name : xls.parse(sheet_name,index_col=0) for sheet_name in xls.sheet_names}
+        else:
+            df_tables = snapshot['tables']
 
-    def load(self,xls_fname):
-        xls = pd.ExcelFile(xls_fname)
         obj_dict = {}
         obj_dict['xls_fname'] = xls_fname
-        df_tables={}
-        df_names={}
-        for sheet_name in xls.sheet_names:
-            df_tables[sheet_name] = xls.parse(sheet_name,index_col=0)
-            df_names[sheet_name] = sheet_name
         obj_dict['tables'] = utils.Bunch(**df_tables)
-        obj_dict['table_names'] = utils.Bunch(**df_names)
+        obj_dict['table_names'] = utils.Bunch(**{sheet_name : sheet_name for sheet_name in df_tables})
 
         self.__dict__.update(**obj_dict)
         self.__refresh_components()
+        self.invalidate()
+
+        if snapshot is not None:
+            self.__indexes = snapshot['indexes']
+        elif snapshot_dir is not False:
+            _write_snapshot(xls_fname,snapshot_dir,df_tables,self.__get_indexes())
+
+    def invalidate(self):
+        """
+        Drop the lookup indexes, they are rebuilt on the next lookup. Call this
+        after changing the tables directly rather than through the add_* methods.
+        """
+        self.__indexes = None
+
+    def __get_indexes(self):
+        if self.__indexes is None: self.__indexes = self.__build_indexes()
+        return self.__indexes
+
+    def __build_indexes(self):
+        defs = self.tables.definitions
+        defs_by_component = {component : df for component,df in defs.groupby(column_names.COMPONENT,sort=False)}
+
+        joined = defs.merge(self.tables.lists, left_on='list_id',right_index=True)
+        joined = joined.merge(self.tables.categories,left_on='id',right_index=True)
+        categories_by_component = {}
+        for component,filtered in joined.groupby(column_names.COMPONENT,sort=False):
+            categories_by_component[component] = filtered[['seq_num','val_numeric','val_text']].set_index('seq_num').sort_index()
+
+        bounds = defs.drop_duplicates([column_names.COMPONENT,column_names.UNITS],keep='first')
+        bounds = bounds.set_index([column_names.COMPONENT,column_names.UNITS]).loc[:,['lower','upper']]
+
+        #row order matters, the first convertible definition of a component is used
+        definitions_key = hashlib.md5(pd.util.hash_pandas_object(
+                                defs.loc[:,[column_names.COMPONENT,column_names.UNITS,column_names.VAR_TYPE]].astype(str),
+                                index=False).values.tobytes()).hexdigest()
+
+        return {
+            'defs_by_component' : defs_by_component,
+            'categories_by_component' : categories_by_component,
+            'bounds' : bounds,
+            'definitions_key' : definitions_key
+        }
 
     def __refresh_components(self):
         components = map(str,self.tables.definitions.component.unique().tolist())
@@ -45,6 +100,7 @@ class data_dictionary(object):
         new_id = _next_id(self.tables.definitions)
         self.tables.definitions.loc[new_id] = [component,units,variable_type,clinical_source,lower_limit,upper_limit,list_id]
         self.__refresh_components()
+        self.invalidate()
         return new_id
 
     def add_panel(self,panel_name,panel_map):
@@ -70,11 +126,13 @@ class data_dictionary(object):
         list_df.loc[new_id] = [list_id,ref_table,ref_id,seq_num]
         list_df.set_index(orig_index_name,inplace=True)
         self.tables.lists = list_df
+        self.invalidate()
         return new_id
 
     def add_category(self,val_numeric,val_text):
         new_id = _next_id(self.tables.categories)
         self.tables.categories.loc[new_id] = [val_numeric,val_text]
+        self.invalidate()
         return new_id
 
     def add_category_list(self,categories,is_ordered=False):
@@ -101,21 +159,57 @@ class data_dictionary(object):
         return pd.concat(def_list)
 
     def get_categories(self,component):
-        joined = self.tables.definitions.merge(self.tables.lists, left_on='list_id',right_index=True)
-        joined = joined.merge(self.tables.categories,left_on='id',right_index=True)
-        filtered = joined.loc[joined.component == component]
-        if filtered.shape[0] == 0: return None
-        out_df = filtered[['seq_num','val_numeric','val_text']].set_index('seq_num').sort_index()
-        return out_df
+        categories = self.__get_indexes()['categories_by_component'].get(component,None)
+        if categories is None: return None
+        return categories.copy()
 
     def defs_for_component(self,component):
-        return self.get_defs({column_names.COMPONENT : component})
+        return self.__defs_for_component(component).copy()
+
+    def __defs_for_component(self,component):
+        #the indexed frame itself, only for reading
+        defs = self.__get_indexes()['defs_by_component'].get(component,None)
+        if defs is None: return self.tables.definitions.iloc[:0]
+        return defs
+
+    def get_bounds(self,component,units):
+        """
+        (lower, upper) of the first definition with these component and units
+        """
+        bounds = self.__get_indexes()['bounds']
+        if (component,units) not in bounds.index: return (pd.np.nan,pd.np.nan)
+        return tuple(bounds.loc[(component,units)].tolist())
+
+    def bounds_table(self):
+        """
+        lower and upper bounds, indexed by (component, units)
+        """
+        return self.__get_indexes()['bounds'].copy()
+
+    def definitions_key(self):
+        """
+        Hash of the definitions' component, units and variable_type columns,
+        in row order
+        """
+        return self.__get_indexes()['definitions_key']
+
+    def fingerprint(self):
+        """
+        Hash of the contents of every table, e.g. to tell that cleaners built
+        on this dictionary changed
+        """
+        md5 = hashlib.md5()
+        for table_name in sorted(self.table_names.__dict__):
+            table = getattr(self.tables,table_name)
+            md5.update(repr((table_name,table.index.name,table.columns.tolist())))
+            md5.update(pd.util.hash_pandas_object(table,index=True).values.tobytes())
+        return md5.hexdigest()
 
     def get_clinical_source(self,component):
-        return self.defs_for_component(component).loc[:,'clinical_source'].iloc[0]
+        return self.__defs_for_component(component).loc[:,'clinical_source'].iloc[0]
 
     def get_variable_type(self,component):
-        return self.defs_for_component(component).loc[:,'variable_type'].iloc[0]
+        return self.__defs_for_component(component).loc[:,'variable_type'].iloc[0]
 
     def get_defs(self,data_specs=[],operator='or'):
         return _filter_defs(self.tables.definitions,data_specs,operator)
@@ -132,3 +226,53 @@ def _filter_defs(defs,specs,operator='or'):
 
 def _next_id(df):
     return max(df.index.tolist())+1
+
+"""
+Snapshots of parsed data dictionaries
+"""
+
+def _snapshot_fname(xls_fname,snapshot_dir):
+    path_hash = hashlib.md5(os.path.abspath(xls_fname)).hexdigest()
+    return os.path.join(snapshot_dir,'data_dictionary_{}.pkl'.format(path_hash))
+
+def _file_md5(fname):
+    with open(fname,'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+def _read_snapshot(xls_fname,snapshot_dir):
+    if snapshot_dir is False: return None
+    snapshot_fname = _snapshot_fname(xls_fname,snapshot_dir)
+    if not os.path.isfile(snapshot_fname): return None
+    try:
+        snapshot = pd.read_pickle(snapshot_fname)
+    except Exception:
+        # e.g. written by another pandas version
+        return None
+    if snapshot.get('version',None) != SNAPSHOT_VERSION: return None
+
+    stat = os.stat(xls_fname)
+    if (snapshot['mtime'],snapshot['size']) == (stat.st_mtime,stat.st_size): return snapshot
+    # touched (e.g. by a checkout) but not changed
+    if snapshot['md5'] == _file_md5(xls_fname):
+        snapshot['mtime'],snapshot['size'] = stat.st_mtime,stat.st_size
+        _pickle_atomic(snapshot,snapshot_fname)
+        return snapshot
+    return None
+
+def _write_snapshot(xls_fname,snapshot_dir,df_tables,indexes):
+    if not os.path.isdir(snapshot_dir): os.makedirs(snapshot_dir)
+    stat = os.stat(xls_fname)
+    _pickle_atomic({
+        'version' : SNAPSHOT_VERSION,
+        'mtime' : stat.st_mtime,
+        'size' : stat.st_size,
+        'md5' : _file_md5(xls_fname),
+        'tables' : df_tables,
+        'indexes' : indexes
+    },_snapshot_fname(xls_fname,snapshot_dir))
+
+def _pickle_atomic(obj,fname):
+    #renamed into place, so other processes never read a half written snapshot
+    tmp_fname = '{}.{}.tmp'.format(fname,os.getpid())
+    pd.to_pickle(obj,tmp_fname)
+    os.rename(tmp_fname,fname)
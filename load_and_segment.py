@@ -246,49 +246,20 @@ def create_seg_df(start_dt,end_dt):
 
 def apply_segments(df_ts,df_segments):
 
-    idx = pd.IndexSlice
-    seg_to_add = {}
-
     #make a copy because we are going to be directly modifying this dataframe
     df_segmented = df_ts.copy()
-    #we set all seg_id to "no segment" for now
-    df_segmented[constants.SEG_ID] = constants.NO_SEGMENT
-    #Iterate across all segments for a given ID
-    for ID,id_segs in df_segments.groupby(level=constants.column_names.ID):
-        has_data = ID in df_segmented.index
-
-        if has_data: id_slice = df_segmented.loc[ID,:]
-        #check segments within that ID, only compare to datetimes from that admission
-        for seg_id,row in id_segs.loc[ID].iterrows():
-            start_dt = row[constants.START_DT]
-            end_dt = row[constants.END_DT]
-
-            if has_data:
-                #Datettime needs to be at or after start_dt, before end_dt
-                #   If start_dt or end_dt is NaN, this signifies all before or all after
-                #   respectively. as a result, if start_dt is nan, then any dt is "after start" etc.
-                after_start = pd.isnull(start_dt) | (id_slice.index >= start_dt)
-                before_end = pd.isnull(end_dt) | (id_slice.index < end_dt)
-                in_seg = after_start & before_end
-
-                #get the dt that should be in this segement
-                dt_in_seg =  id_slice.loc[in_seg].index.tolist()
-
-                if len(dt_in_seg) > 0:
-                    df_segmented.loc[idx[ID,dt_in_seg],constants.SEG_ID] = seg_id
-                    continue
-
-            in_seg_dt = start_dt
-            if pd.isnull(in_seg_dt):
-                in_seg_dt = end_dt - pd.Timedelta(value=1,unit='s')
-            seg_to_add[(ID,in_seg_dt)] = seg_id
+    #assign every row to its segment in one sorted pass, "no segment" if it falls in none
+    seg_ids = assign_segments(df_ts.index,df_segments)
+    df_segmented[constants.SEG_ID] = seg_ids
 
+    #segments that did not receive any row still need a placeholder row
+    seg_to_add = empty_segments(df_ts.index,seg_ids,df_segments)
 
     # create df for the empty segments & concat with existing dataframe
     if len(seg_to_add) > 0:
-        empty_seg_index = pd.MultiIndex.from_tuples(seg_to_add.keys(),names=df_ts.index.names)
+        empty_seg_index = pd.MultiIndex.from_tuples(seg_to_add.index.tolist(),names=df_ts.index.names)
         df_empty_seg = pd.DataFrame(columns=df_ts.columns,index=empty_seg_index)
-        df_empty_seg.loc[:,constants.SEG_ID] = seg_to_add.values()
+        df_empty_seg.loc[:,constants.SEG_ID] = seg_to_add.values
         df_segmented = pd.concat([df_segmented,df_empty_seg])
 
     #format output dataframe
@@ -298,3 +269,58 @@ def apply_segments(df_ts,df_segments):
 
 
     return df_segmented
+
+def assign_segments(index,df_segments):
+    """
+    Returns the seg_id for every (id, datetime) entry of index, or NO_SEGMENT.
+
+    A datetime is in a segment if it is at or after start_dt and before end_dt;
+    a NaT start_dt/end_dt means all before/all after respectively. Segments of
+    the same id are expected not to overlap, as with create_seg_df.
+    """
+    ID = constants.column_names.ID
+    DATETIME = constants.column_names.DATETIME
+
+    seg_ids = pd.np.full(len(index),constants.NO_SEGMENT,dtype=int)
+    if (len(index) == 0) or df_segments.empty: return seg_ids
+
+    df_rows = pd.DataFrame({
+        ID : index.get_level_values(ID),
+        DATETIME : index.get_level_values(DATETIME),
+        'row' : pd.np.arange(len(index))
+    })
+    #merge_asof can't match null datetimes, those rows keep NO_SEGMENT
+    df_rows = df_rows[df_rows[DATETIME].notnull()]
+    if df_rows.empty: return seg_ids
+
+    #open ended bounds become the earliest/latest possible timestamp
+    df_bounds = df_segments.reset_index()
+    df_bounds[constants.START_DT] = pd.to_datetime(df_bounds[constants.START_DT]).fillna(pd.Timestamp.min)
+    df_bounds[constants.END_DT] = pd.to_datetime(df_bounds[constants.END_DT]).fillna(pd.Timestamp.max)
+    df_bounds[ID] = df_bounds[ID].astype(df_rows[ID].dtype)
+
+    #match every row to the last segment of its id that starts at or before it
+    df_matched = pd.merge_asof(df_rows.sort_values(DATETIME,kind='mergesort'),
+                               df_bounds.sort_values(constants.START_DT,kind='mergesort'),
+                               left_on=DATETIME,
+                               right_on=constants.START_DT,
+                               by=ID)
+
+    #then make sure it is also before that segment ends
+    in_seg = (df_matched[DATETIME] < df_matched[constants.END_DT]).values
+    seg_ids[df_matched['row'].values[in_seg]] = df_matched[constants.SEG_ID].values[in_seg].astype(int)
+    return seg_ids
+
+def empty_segments(index,seg_ids,df_segments):
+    """
+    Returns a Series of seg_id indexed by (id, datetime) placeholders for each
+    segment that was not assigned any row. The placeholder datetime is the
+    start_dt, or one second before end_dt if the segment has no start.
+    """
+    assigned = pd.MultiIndex.from_arrays([index.get_level_values(constants.column_names.ID),seg_ids])
+    df_empty = df_segments.loc[~df_segments.index.isin(assigned)]
+
+    in_seg_dt = df_empty[constants.START_DT].fillna(df_empty[constants.END_DT] - pd.Timedelta(value=1,unit='s'))
+    empty_seg_index = pd.MultiIndex.from_arrays([df_empty.index.get_level_values(constants.column_names.ID),in_seg_dt.values])
+    seg_to_add = pd.Series(df_empty.index.get_level_values(constants.SEG_ID),index=empty_seg_index)
+    return seg_to_add[~seg_to_add.index.duplicated(keep='last')]
@@ -5,7 +5,10 @@ import logger
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.pipeline import Pipeline
 from fuzzywuzzy import fuzz
+from fuzzywuzzy import utils as fuzz_utils
 import re
+import os
+import hashlib
 import random
 import units
 import transformers
@@ -16,6 +19,8 @@ import matplotlib.pyplot as plt
 ITEMID = 'itemid'
 SUBINDEX = 'subindex'
 HADM_ID = 'hadm_id'
+ITEM_CATALOG_DIR = 'cache'
+SEARCH_COLUMNS = ['category','label','abbreviation','unitname']
 
 UOM_MAP = {
     '#': 'number',
@@ -48,6 +53,9 @@ UOM_MAP = {
      '/mic l':'1/uL',
      'K/uL':'x10e3/uL'
     }
+UOM_SUBS = [(re.compile(to_replace,flags=re.IGNORECASE),replacement) for to_replace,replacement in UOM_MAP.iteritems()]
+UOM_MATCHER = re.compile('|'.join('(?:{})'.format(to_replace) for to_replace in UOM_MAP.iterkeys()),flags=re.IGNORECASE)
+BPM_UOMS = ['BPM','bpm']
 """
 EXPLORING MIMIC-III database
 """
@@ -59,16 +67,12 @@ class explorer(object):
             mimic_conn = connect()
         columns_to_keep = ['label','abbreviation','itemid','linksto','category','unitname']
         self.mimic_conn = mimic_conn
-        self.df_all_defs = item_defs(self.mimic_conn)[columns_to_keep]
-        self.df_all_defs.set_index('itemid',inplace=True, drop=True)
+        self.df_all_defs = get_item_catalog(self.mimic_conn).df_all_defs[columns_to_keep]
+        self.df_all_defs = self.df_all_defs.set_index('itemid', drop=True)
 
     def search(self,terms,loinc_code=None):
 
-        results = None
-        for term in terms:
-            score = self.df_all_defs[['category','label','abbreviation','unitname']].applymap(lambda x: fuzzy_score(str(x),term)).max(axis=1)
-            if results is None: results = score
-            else: results = pd.concat([results, score], axis=1).max(axis=1)
+        results = get_item_catalog(self.mimic_conn).search_index().scores(terms)
 
         results.name = 'score'
         return self.df_all_defs.join(results.to_frame()).sort_values('score',ascending=False)
@@ -104,6 +108,113 @@ class explorer(object):
         return df
 
 
+class SearchIndex(object):
+    """
+    Bigram inverted index over the distinct cell strings of a dataframe.
+    For each term, fuzzy_score is first computed for the strings containing
+    or contained in it, and the n_candidates strings sharing the most
+    bigrams with it (by count and by jaccard). Then the other strings are
+    scored in order of an upper bound on their score, until none can reach
+    the top_n rows, so those rank and score exactly as if every string was
+    scored. Strings that are never scored count as 0.
+    """
+
+    def __init__(self,df,n_candidates=200,top_n=20):
+        self.index = df.index
+        self.n_candidates = n_candidates
+        self.top_n = top_n
+
+        cells = df.applymap(str)
+        codes,strings = pd.factorize(cells.values.ravel())
+        self.codes = codes.reshape(cells.shape)
+        self.strings = strings.tolist()
+        self.lower_strings = [string.lower() for string in self.strings]
+        self.lengths = pd.np.array(map(len,self.lower_strings),dtype=int)
+        self.sorted_lengths = pd.np.array([len(_sorted_tokens(string)) for string in self.strings],dtype=int)
+
+        grams = {}
+        self.gram_counts = pd.np.zeros(len(self.strings),dtype=int)
+        for string_ix,string in enumerate(self.strings):
+            string_grams = bigrams(string)
+            self.gram_counts[string_ix] = len(string_grams)
+            for gram in string_grams:
+                grams.setdefault(gram,[]).append(string_ix)
+        self.grams = {gram : pd.np.array(ixs) for gram,ixs in grams.iteritems()}
+
+    def scores(self,terms):
+        """
+        Max fuzzy_score of each row across its cells and the terms
+        """
+        string_scores = pd.np.zeros(len(self.strings))
+        is_scored = pd.np.zeros(len(self.strings),dtype=bool)
+        bounds = pd.np.zeros(len(self.strings))
+        for term in terms:
+            bounds = pd.np.maximum(bounds,self.score_bounds(term))
+            self.__score(self.candidates(term),terms,string_scores,is_scored)
+
+        #score the rest, highest bound first, until none can reach the top_n rows
+        remaining = pd.np.argsort(-bounds,kind='mergesort')
+        remaining = remaining[~is_scored[remaining]]
+        for start in range(0,len(remaining),self.n_candidates):
+            row_scores = string_scores[self.codes].max(axis=1)
+            if (len(row_scores) >= self.top_n) and \
+                    (pd.np.sort(row_scores)[-self.top_n] >= bounds[remaining[start]]): break
+            self.__score(remaining[start:start + self.n_candidates],terms,string_scores,is_scored)
+        return pd.Series(string_scores[self.codes].max(axis=1),index=self.index)
+
+    def __score(self,string_ixs,terms,string_scores,is_scored):
+        for string_ix in string_ixs:
+            if is_scored[string_ix]: continue
+            string_scores[string_ix] = max(fuzzy_score(self.strings[string_ix],term) for term in terms)
+            is_scored[string_ix] = True
+
+    def score_bounds(self,term):
+        """
+        Upper bound of fuzzy_score(string,term) for every string that does
+        not contain and is not contained in term (those are always scored):
+        partial_ratio is at most 100, ratio and token_sort_ratio at most
+        200 times the shorter length over the summed lengths (+1 for rounding)
+        """
+        term = term.lower()
+        bounds = (100 + _length_ratio_bound(self.lengths,len(term)) +
+                    _length_ratio_bound(self.sorted_lengths,len(_sorted_tokens(term))))/3.0
+        bounds[self.lengths == 0] = 0
+        if len(term) == 0: bounds[:] = 0
+        return bounds
+
+    def candidates(self,term):
+        term_grams = bigrams(term)
+        shared = pd.np.zeros(len(self.strings),dtype=int)
+        for gram in term_grams:
+            ixs = self.grams.get(gram,None)
+            if ixs is not None: shared[ixs] += 1
+
+        jaccard = shared / (len(term_grams) + self.gram_counts - shared).clip(min=1).astype(float)
+        by_shared = pd.np.argsort(-shared,kind='mergesort')[:self.n_candidates]
+        by_jaccard = pd.np.argsort(-jaccard,kind='mergesort')[:self.n_candidates]
+        candidates = pd.np.union1d(by_shared,by_jaccard)
+        candidates = candidates[shared[candidates] > 0]
+
+        #substrings get a bonus in fuzzy_score, so they are always candidates
+        term = term.lower()
+        substrings = [ix for ix,string in enumerate(self.lower_strings)
+                        if (len(string) > 0) and ((string in term) or (term in string))]
+        return pd.np.union1d(candidates,substrings).astype(int)
+
+def _sorted_tokens(x):
+    #the string token_sort_ratio compares
+    return u' '.join(sorted(fuzz_utils.full_process(x,force_ascii=True).split()))
+
+def _length_ratio_bound(lengths,length):
+    total = (lengths + length).clip(min=1).astype(float)
+    bounds = 200*pd.np.minimum(lengths,length)/total + 1
+    bounds[pd.np.minimum(lengths,length) == 0] = 0
+    return bounds
+
+def bigrams(x):
+    x = ' {} '.format(x.lower())
+    return set(x[i:i+2] for i in range(len(x)-1))
+
 def fuzzy_score(x,y):
     if len(x)==0 or len(y) == 0: return 0
     x = x.lower()
@@ -131,21 +242,42 @@ EXTRACTING Data from MIMIC-III
 
 class MimicETLManager(ETLManager):
 
-    def __init__(self,hdf5_fname,mimic_item_map_fname,data_dict):
+    def __init__(self,hdf5_fname,mimic_item_map_fname,data_dict,store=None):
         self.conn = connect()
         self.item_map_fname = mimic_item_map_fname
         self.data_dict = data_dict
+        # loaded before any workers are forked, so they inherit them
+        get_item_catalog(self.conn)
+        units.prewarm(data_dict.tables.definitions[column_names.UNITS].dropna().unique().tolist())
         cleaners = standard_cleaners(data_dict)
-        super(MimicETLManager,self).__init__(cleaners,hdf5_fname)
+        super(MimicETLManager,self).__init__(cleaners,hdf5_fname,store)
 
     def extract(self,component):
         item_map = pd.read_csv(self.item_map_fname)
         return extract_component(self.conn,component,item_map)
 
+    def extract_delta(self,component,itemids,ids):
+        item_map = pd.read_csv(self.item_map_fname)
+        if not (itemids == ALL):
+            item_map = item_map[item_map.itemid.isin(itemids)]
+        return extract_component(self.conn,component,item_map,hadm_ids=ids)
+
+    def component_items(self,component):
+        item_map = pd.read_csv(self.item_map_fname)
+        return items_for_components(item_map,[component])
+
+    def extract_chunks(self,component,chunksize):
+        item_map = pd.read_csv(self.item_map_fname)
+        return stream_component(self.conn,component,item_map,chunksize=chunksize)
+
     def transform(self,df,component):
         transformers = transform_pipeline(component,self.data_dict)
         return transformers.fit_transform(df)
 
+    def init_worker(self):
+        #connections can't be shared with the parent process
+        self.conn = connect()
+
     def extracted_ids(self,df_extracted):
         return df_extracted[column_names.ID].unique().tolist()
 
@@ -157,45 +289,94 @@ class MimicETLManager(ETLManager):
 
 
 def extract_component(mimic_conn,component,item_map,hadm_ids=ALL):
-    itemids = items_for_components(item_map,[component])
-    if len(itemids) == 0: return None
-    #Get item defs and filter to what we want
-    df_item_defs = item_defs(mimic_conn)
-    df_item_defs = df_item_defs[df_item_defs.itemid.isin(itemids)]
-    df_item_defs = df_item_defs[~(df_item_defs.linksto == '')]
-    grouped = df_item_defs.groupby('linksto')
-
     df_list = []
-    df_columns = column_map()
+    hadm_where_case,params = hadm_id_filter(hadm_ids)
 
-    too_many_ids = len(hadm_ids) > 2000
-
-    for table,group in grouped:
-        itemids = group.itemid.astype(int).tolist()
-        logger.log('Extracting {} items from {}'.format(len(itemids),table))
+    for table,itemids,psql_col,df_col in component_selects(mimic_conn,component,item_map):
         is_iemv = table == 'inputevents_mv'
-        df_col = df_columns.columns.tolist() + (['statusdescription'] if is_iemv else [])
-        for ix,column_set in df_columns.loc[[table]].iterrows():
-            psql_col = column_set.tolist() + (['statusdescription'] if is_iemv else [])
-            query = 'SELECT {} FROM mimiciii.{} WHERE itemid = ANY (ARRAY{})'.format(','.join(psql_col),table,itemids)
-            if not (hadm_ids == ALL) and not too_many_ids:
-                query += ' AND hadm_id = ANY (ARRAY{})'.format(hadm_ids)
-            df = pd.read_sql_query(query,mimic_conn)
-            df.columns = df_col
-            if too_many_ids:
-                df = df[df[column_names.ID].isin(hadm_ids)]
-            if is_iemv:
-                df = df.loc[df['statusdescription'].astype(str) != 'Rewritten']
-                df.drop('statusdescription', axis=1,inplace=True)
-            df_list.append(df)
-
-
+        df_col = df_col + (['statusdescription'] if is_iemv else [])
+        psql_col = psql_col + (['statusdescription'] if is_iemv else [])
+        query = 'SELECT {} FROM mimiciii.{} WHERE itemid = ANY (ARRAY{})'.format(','.join(psql_col),table,itemids)
+        if hadm_where_case is not None:
+            query += ' AND {}'.format(hadm_where_case)
+        df = pd.read_sql_query(query,mimic_conn,params=params)
+        df.columns = df_col
+        if is_iemv:
+            df = df.loc[df['statusdescription'].astype(str) != 'Rewritten']
+            df.drop('statusdescription', axis=1,inplace=True)
+        df_list.append(df)
+
+    if len(df_list) == 0: return None
 
     logger.log('Combine DF')
     df_all = pd.concat(df_list)
 
     return df_all
 
+def stream_component(mimic_conn,component,item_map,hadm_ids=ALL,chunksize=500000):
+    """
+    Generator version of extract_component. All tables are read in one
+    query, ordered by hadm_id, through a server-side cursor. Chunks of about
+    chunksize rows are yielded, each holding every row of its hadm_ids.
+    """
+    hadm_where_case,params = hadm_id_filter(hadm_ids)
+
+    selects = []
+    for table,itemids,psql_col,df_col in component_selects(mimic_conn,component,item_map):
+        #value columns differ in type across tables, which a UNION won't allow
+        psql_col = ['{} AS {}'.format(p_col if d_col != column_names.VALUE else 'CAST({} AS text)'.format(p_col),d_col)
+                        for p_col,d_col in zip(psql_col,df_col)]
+        select = 'SELECT {} FROM mimiciii.{} WHERE itemid = ANY (ARRAY{})'.format(','.join(psql_col),table,itemids)
+        if hadm_where_case is not None:
+            select += ' AND {}'.format(hadm_where_case)
+        if table == 'inputevents_mv':
+            select += " AND statusdescription IS DISTINCT FROM 'Rewritten'"
+        selects.append(select)
+
+    if len(selects) == 0: return
+
+    query = '{} ORDER BY {}'.format(' UNION ALL '.join(selects),column_names.ID)
+    conn = mimic_conn.connect().execution_options(stream_results=True)
+    try:
+        chunks = pd.read_sql_query(query,conn,params=params,chunksize=chunksize)
+        for df in utils.whole_id_chunks(chunks):
+            logger.log('Extracted chunk: {}'.format(df.shape))
+            yield df
+    finally:
+        conn.close()
+
+def hadm_id_filter(hadm_ids):
+    """
+    Returns a where condition restricting hadm_id to hadm_ids, and the query
+    params it needs (None, None for ALL). The ids are sent as a single bound
+    array that the server unnests and semi-joins, so only the requested rows
+    come back no matter how many ids there are.
+    """
+    return id_filter(HADM_ID,hadm_ids)
+
+def id_filter(column,ids,param_name=None):
+    if ids == ALL: return None,None
+    if param_name is None: param_name = column + 's'
+    where_case = '{} IN (SELECT unnest(%({})s::integer[]))'.format(column,param_name)
+    return where_case,{param_name : [int(i) for i in ids]}
+
+def component_selects(mimic_conn,component,item_map):
+    """
+    Yields (table, itemids, psql columns, df columns) for every select
+    needed to extract a component.
+    """
+    itemids = items_for_components(item_map,[component])
+    if len(itemids) == 0: return
+    #Group the items by the table their data is in
+    tables = get_item_catalog(mimic_conn).items_by_table(itemids)
+
+    df_columns = column_map()
+
+    for table,itemids in sorted(tables.iteritems()):
+        logger.log('Extracting {} items from {}'.format(len(itemids),table))
+        for ix,column_set in df_columns.loc[[table]].iterrows():
+            yield table,itemids,column_set.tolist(),df_columns.columns.tolist()
+
 
 
 def get_context_data(hadm_ids=ALL,mimic_conn=None):
@@ -219,7 +400,7 @@ def get_context_data(hadm_ids=ALL,mimic_conn=None):
 
 def hadm_data(mimic_conn,hadm_ids):
     """
-    expects a TUPLE of hadm_ids
+    expects a list of hadm_ids, or ALL
     """
 
 
@@ -235,12 +416,12 @@ def hadm_data(mimic_conn,hadm_ids):
     @@@@@@@@@@@@
     """
     table = 'mimiciii.admissions'
-    hadm_where_case = None if hadm_ids == ALL else 'hadm_id IN {}'.format(tuple(hadm_ids))
+    hadm_where_case,hadm_params = hadm_id_filter(hadm_ids)
     col_psql = ['subject_id', HADM_ID, 'admittime', 'dischtime', 'language',
                         'religion','marital_status', 'ethnicity', 'diagnosis','admission_location']
     col_df = ['pt_id',HADM_ID,START_DT,END_DT,'lang',
                         'religion','marital_status','ethnicity','dx_info','admission_location']
-    df_hadm = context_extraction_helper(mimic_conn,table,col_psql,col_df,hadm_where_case)
+    df_hadm = context_extraction_helper(mimic_conn,table,col_psql,col_df,hadm_where_case,hadm_params)
 
     """
     @@@@@@@@@@@@
@@ -254,10 +435,11 @@ def hadm_data(mimic_conn,hadm_ids):
     """
 
     table = 'mimiciii.patients'
-    pt_ids = df_hadm['pt_id'].unique().tolist()
+    pt_ids = ALL if hadm_ids == ALL else df_hadm['pt_id'].unique().tolist()
+    pt_where_case,pt_params = id_filter('subject_id',pt_ids)
     col_psql = ['subject_id','gender','dob','dod']
     col_df = ['pt_id','gender','dob','dod']
-    df_pt = context_extraction_helper(mimic_conn,table,col_psql,col_df)
+    df_pt = context_extraction_helper(mimic_conn,table,col_psql,col_df,pt_where_case,pt_params)
 
     """
 
@@ -273,7 +455,7 @@ def hadm_data(mimic_conn,hadm_ids):
     table = 'mimiciii.diagnoses_icd'
     col_psql = ['subject_id',HADM_ID,'seq_num','icd9_code']
     col_df = ['pt_id',HADM_ID,'icd_rank','icd_code']
-    df_icd = context_extraction_helper(mimic_conn,table,col_psql,col_df,hadm_where_case)
+    df_icd = context_extraction_helper(mimic_conn,table,col_psql,col_df,hadm_where_case,hadm_params)
 
     """
     @@@@@@@@@@@@
@@ -314,8 +496,8 @@ def icu_data(mimic_conn,hadm_ids):
     table = 'mimiciii.icustays'
     col_psql = [HADM_ID,'icustay_id','dbsource','first_careunit','last_careunit','intime','outtime','los']
     col_df = [HADM_ID,'icustay_id','dbsource','first_icu','last_icu','intime','outtime','los']
-    hadm_where_case = None if hadm_ids == ALL else 'hadm_id IN {}'.format(tuple(hadm_ids))
-    df_icu = context_extraction_helper(mimic_conn,table,col_psql,col_df,hadm_where_case)
+    hadm_where_case,hadm_params = hadm_id_filter(hadm_ids)
+    df_icu = context_extraction_helper(mimic_conn,table,col_psql,col_df,hadm_where_case,hadm_params)
 
 
     """
@@ -326,9 +508,9 @@ def icu_data(mimic_conn,hadm_ids):
 
     return df_icu
 
-def context_extraction_helper(mimic_conn,table,col_psql,col_df,where_case=None):
+def context_extraction_helper(mimic_conn,table,col_psql,col_df,where_case=None,params=None):
     query = utils.simple_sql_query(table,col_psql,where_case)
-    df = pd.read_sql_query(query,mimic_conn)
+    df = pd.read_sql_query(query,mimic_conn,params=params)
     rename_dict = dict(zip(col_psql,col_df))
     df.rename(index=str,columns=rename_dict,inplace=True)
     return df
@@ -411,6 +593,90 @@ def item_defs(mimic_conn):
     df_all_items = pd.concat([df_labitems,df_items])
     return df_all_items
 
+_ITEM_CATALOGS = {}
+
+def get_item_catalog(mimic_conn,cache_dir=ITEM_CATALOG_DIR):
+    """
+    Returns the ItemCatalog for this database, shared across the process
+    """
+    key = (db_identity(mimic_conn),cache_dir)
+    if key not in _ITEM_CATALOGS:
+        _ITEM_CATALOGS[key] = ItemCatalog(mimic_conn,cache_dir)
+    return _ITEM_CATALOGS[key]
+
+def db_identity(mimic_conn):
+    url = mimic_conn.url
+    identity = '{}@{}:{}/{}'.format(url.username,url.host,url.port,url.database)
+    return hashlib.md5(identity).hexdigest()[:16]
+
+class ItemCatalog(object):
+    """
+    d_items and d_labitems, cached on disk per database (see db_identity) and
+    indexed by itemid and linksto. Call refresh() to re-query the item tables,
+    or invalidate() to drop the cached copy.
+    """
+
+    def __init__(self,mimic_conn,cache_dir=ITEM_CATALOG_DIR):
+        self.mimic_conn = mimic_conn
+        self.cache_fname = os.path.join(cache_dir,'item_defs_{}.pkl'.format(db_identity(mimic_conn)))
+        self.load()
+
+    def load(self):
+        df_all_defs = None
+        if os.path.isfile(self.cache_fname):
+            try:
+                df_all_defs = pd.read_pickle(self.cache_fname)
+            except Exception:
+                # e.g. written by another pandas version
+                df_all_defs = None
+        if df_all_defs is None:
+            df_all_defs = self.refresh()
+        self.__build_indexes(df_all_defs)
+        return df_all_defs
+
+    def refresh(self):
+        df_all_defs = item_defs(self.mimic_conn)
+        cache_dir = os.path.dirname(self.cache_fname)
+        if cache_dir and not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+        #renamed into place, so other processes never read a half written file
+        tmp_fname = '{}.{}.tmp'.format(self.cache_fname,os.getpid())
+        df_all_defs.to_pickle(tmp_fname)
+        os.rename(tmp_fname,self.cache_fname)
+        self.__build_indexes(df_all_defs)
+        return df_all_defs
+
+    def invalidate(self):
+        if os.path.isfile(self.cache_fname): os.remove(self.cache_fname)
+        for key,catalog in _ITEM_CATALOGS.items():
+            if catalog is self: del _ITEM_CATALOGS[key]
+
+    def __build_indexes(self,df_all_defs):
+        self.df_all_defs = df_all_defs
+        self.__search_index = None
+        self.table_by_itemid = {}
+        self.itemids_by_table = {}
+        for itemid,table in zip(df_all_defs.itemid.astype(int).tolist(),df_all_defs.linksto.tolist()):
+            if pd.isnull(table) or (table == ''): continue
+            self.table_by_itemid[itemid] = table
+            self.itemids_by_table.setdefault(table,[]).append(itemid)
+
+    def search_index(self):
+        if self.__search_index is None:
+            df_search = self.df_all_defs.set_index('itemid')[SEARCH_COLUMNS]
+            self.__search_index = SearchIndex(df_search)
+        return self.__search_index
+
+    def items_by_table(self,itemids):
+        """
+        {table: [itemids]} for the itemids that have data in a table
+        """
+        tables = {}
+        for itemid in itemids:
+            table = self.table_by_itemid.get(int(itemid),None)
+            if table is None: continue
+            tables.setdefault(table,[]).append(int(itemid))
+        return tables
+
 def items_for_components(item_map,components=ALL):
     if not (components == ALL):
         item_map = item_map[item_map.component.isin(components)]
@@ -454,21 +720,43 @@ class CleanUnits(BaseEstimator,TransformerMixin):
         return df
 
 def clean_uom(df,component,data_dict):
-    grouped = df.groupby(column_names.UNITS)
-    for old_uom,group in grouped:
-        new_uom = process_uom(old_uom,component,data_dict)
-        df.loc[group.index,column_names.UNITS] = new_uom
-        if not (old_uom == new_uom):
-            df.loc[group.index,ITEMID] = utils.append_to_description(df.loc[group.index,ITEMID].astype(str),old_uom)
+    #map each distinct unit once, then remap every row by its code
+    codes,old_uoms = pd.factorize(df[column_names.UNITS])
+    if len(old_uoms) == 0: return df
+    new_uoms = pd.np.array([process_uom(uom,component,data_dict) for uom in old_uoms],dtype=object)
+    uom_changed = new_uoms != old_uoms.values.astype(object)
+
+    has_uom = codes >= 0
+    new_units = df[column_names.UNITS].values.astype(object)
+    new_units[has_uom] = new_uoms[codes[has_uom]]
+    changed = has_uom.copy()
+    changed[has_uom] = uom_changed[codes[has_uom]]
+
+    if changed.any():
+        old_desc = df[ITEMID][changed].astype(str)
+        old_units = df[column_names.UNITS][changed].astype(str).values
+        df[ITEMID] = df[ITEMID].astype(object)
+        df.loc[changed,ITEMID] = utils.append_to_description(old_desc,old_units).values
+    df[column_names.UNITS] = new_units
     return df
 
+_UOM_CACHE = {}
+
 def process_uom(units,component,data_dict):
+    #only BPM depends on the component
+    key = (units,component) if units in BPM_UOMS else units
+    if key not in _UOM_CACHE:
+        _UOM_CACHE[key] = _process_uom(units,component,data_dict)
+    return _UOM_CACHE[key]
+
+def _process_uom(units,component,data_dict):
 
-    if units in ['BPM','bpm']:
+    if units in BPM_UOMS:
         if component == data_dict.components.HEART_RATE: units = 'beats/min'
         if component == data_dict.components.RESPIRATORY_RATE: units = 'breaths/min'
-    for to_replace,replacement in UOM_MAP.iteritems():
-        units = re.sub(to_replace, replacement,units,flags=re.IGNORECASE)
+    if UOM_MATCHER.search(units) is None: return units
+    for to_replace,replacement in UOM_SUBS:
+        units = to_replace.sub(replacement,units)
     return units
 
 class clean_extract(BaseEstimator,TransformerMixin):
@@ -522,9 +810,9 @@ def transform_pipeline(component,data_dict):
 
 def standard_cleaners(data_dict):
     category_map = mimic_category_map(data_dict)
-    ureg = units.MedicalUreg()
+    ureg = units.get_ureg()
     return Pipeline([
-        ('aggregate_same_datetime',transformers.same_index_aggregator(lambda grp:grp.iloc[0])),
+        ('aggregate_same_datetime',transformers.same_index_aggregator('first')),
         ('split_dtype',transformers.split_dtype()),
         ('standardize_columns',transformers.column_standardizer(data_dict,ureg)),
         ('standardize_categories',transformers.standardize_categories(data_dict,category_map)),
@@ -578,7 +866,7 @@ def ETL(extractor,
     logger.log('SETUP',new_level=True)
 
     category_map = mimic_category_map(data_dict)
-    ureg = units.MedicalUreg()
+    ureg = units.get_ureg()
 
     transformer = transform_pipeline()
 
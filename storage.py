@@ -0,0 +1,344 @@
+import abc
+import json
+import os
+import shutil
+import pandas as pd
+import utils
+from constants import column_names
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+ID_RANGE = 'id_range'
+METADATA_KEY = 'icu_ml'
+MANIFEST = 'manifest'
+ID_INDEX = 'id_index'
+
+"""
+Component storage backends
+"""
+
+class ComponentStore(object):
+
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def write(self,df,path,append=False):
+        return
+
+    @abc.abstractmethod
+    def read(self,path,ids=None,specs=None):
+        """
+        ids: only return rows for these ids
+        specs: complex_row_mask style specs on the column levels,
+            e.g. {'units':'mmHg','status':'known'}; only matching columns are read
+        """
+        return
+
+    @abc.abstractmethod
+    def __contains__(self,path):
+        return
+
+    @abc.abstractmethod
+    def read_manifest(self,path):
+        """
+        The dict saved with write_manifest, None if there is none
+        """
+        return
+
+    @abc.abstractmethod
+    def write_manifest(self,path,manifest):
+        return
+
+
+class HDF5Store(ComponentStore):
+    """
+    Next to each component, an id index of (id, start, stop) rows for every
+    run of consecutive rows with the same id is kept, so that reads for a
+    set of ids select those rows directly instead of evaluating a where
+    clause.
+
+    long_format: store only the non-null, non-zero-dummy cells of
+        components, as rows of (id, datetime, column_code, value), with text
+        cells in a table of their own (see utils.to_long). read still
+        returns the same wide dataframes, widened after ids and specs are
+        applied; read_long returns the cells as they are stored.
+    """
+
+    def __init__(self,hdf5_fname,long_format=False):
+        self.hdf5_fname = hdf5_fname
+        self.long_format = long_format
+
+    def write(self,df,path,append=False):
+        data_path,_ = utils.deconstucted_paths(path)
+        store = pd.HDFStore(self.hdf5_fname)
+        nrows_before = store.get_storer(data_path).nrows if append and (data_path in store) else 0
+        store.close()
+
+        if self.long_format: utils.write_long(df,self.hdf5_fname,path=path,append=append)
+        else: utils.deconstruct_and_write(df,self.hdf5_fname,path=path,append=append)
+        self.__update_id_index(path,nrows_before)
+
+    def read(self,path,ids=None,specs=None):
+        return self.__read(path,specs=specs,**self.__row_selection(path,ids))
+
+    def read_long(self,path,ids=None,specs=None):
+        """
+        The cells of a long format component, without widening them: see
+        utils.read_long with wide=False
+        """
+        if not self.long_format: raise ValueError('long reads need an HDF5Store with long_format=True')
+        return utils.read_long(self.hdf5_fname,path=path,specs=specs,wide=False,**self.__row_selection(path,ids))
+
+    def __row_selection(self,path,ids):
+        """
+        where/start/stop arguments that read the rows of ids
+        """
+        if ids is None: return {}
+        ids = sorted(list(set(ids)))
+
+        starts,stops = self.__id_ranges(path,ids)
+        if starts is None:
+            # no up to date id index, e.g. written before there was one
+            return {'where' : '{} in {}'.format(column_names.ID,ids)}
+        if len(starts) <= 1:
+            start,stop = (starts[0],stops[0]) if len(starts) == 1 else (0,0)
+            return {'start' : start,'stop' : stop}
+        return {'where' : _range_coordinates(starts,stops)}
+
+    def __read(self,path,**kwargs):
+        if self.long_format: return utils.read_long(self.hdf5_fname,path=path,**kwargs)
+        return utils.read_and_reconstruct(self.hdf5_fname,path=path,**kwargs)
+
+    def __update_id_index(self,path,nrows_before):
+        data_path,_ = utils.deconstucted_paths(path)
+        id_path = '{}/{}'.format(path,ID_INDEX)
+        store = pd.HDFStore(self.hdf5_fname)
+        try:
+            nrows = store.get_storer(data_path).nrows
+            if (nrows_before > 0) and (nrows >= nrows_before) and \
+                    (id_path in store) and (store.get_storer(id_path).attrs.nrows == nrows_before):
+                # rows were only added at the end, only they need indexing
+                new_ids = store.select_column(data_path,column_names.ID,start=nrows_before).values
+                id_index = pd.concat([store[id_path],_id_runs(new_ids,offset=nrows_before)],ignore_index=True)
+            else:
+                id_index = _id_runs(store.select_column(data_path,column_names.ID).values)
+            store.put(id_path,id_index)
+            store.get_storer(id_path).attrs.nrows = nrows
+        finally:
+            store.close()
+
+    def __id_ranges(self,path,ids):
+        """
+        Sorted (starts, stops) of the row ranges holding ids, adjacent ranges
+        merged. (None, None) if the id index is missing or out of date.
+        """
+        data_path,_ = utils.deconstucted_paths(path)
+        id_path = '{}/{}'.format(path,ID_INDEX)
+        store = pd.HDFStore(self.hdf5_fname)
+        try:
+            if (id_path not in store) or \
+                    (getattr(store.get_storer(id_path).attrs,'nrows',None) != store.get_storer(data_path).nrows):
+                return None,None
+            id_index = store[id_path]
+        finally:
+            store.close()
+
+        runs = id_index[id_index[column_names.ID].isin(ids)].sort_values('start')
+        starts,stops = runs['start'].values,runs['stop'].values
+        if len(starts) == 0: return starts,stops
+        is_new_range = pd.np.r_[True,starts[1:] != stops[:-1]]
+        is_range_end = pd.np.r_[is_new_range[1:],True]
+        return starts[is_new_range],stops[is_range_end]
+
+    def __contains__(self,path):
+        store = pd.HDFStore(self.hdf5_fname)
+        is_in = path in store
+        store.close()
+        return is_in
+
+    def read_manifest(self,path):
+        manifest_path = '{}/{}'.format(path,MANIFEST)
+        store = pd.HDFStore(self.hdf5_fname)
+        try:
+            if manifest_path not in store: return None
+            return json.loads(store[manifest_path].iloc[0])
+        finally:
+            store.close()
+
+    def write_manifest(self,path,manifest):
+        manifest_path = '{}/{}'.format(path,MANIFEST)
+        store = pd.HDFStore(self.hdf5_fname)
+        store.put(manifest_path,pd.Series([json.dumps(manifest)]))
+        store.close()
+
+
+class ParquetStore(ComponentStore):
+    """
+    Each component is a directory of parquet files, partitioned into
+    sub-directories by id range (id // partition_size). The column MultiIndex
+    is kept in the schema metadata of every file, so files appended later
+    may carry different columns.
+    """
+
+    def __init__(self,root_dir,partition_size=10000,row_group_size=100000):
+        if pq is None:
+            raise ImportError('pyarrow is required to use a ParquetStore')
+        self.root_dir = root_dir
+        self.partition_size = partition_size
+        self.row_group_size = row_group_size
+
+    def write(self,df,path,append=False):
+        comp_dir = self.component_dir(path)
+        if (not append) and os.path.isdir(comp_dir):
+            shutil.rmtree(comp_dir)
+
+        data,columns = utils.deconstruct_df(df)
+        index_names = list(df.index.names)
+        data.columns = map(str,data.columns)
+        data = data.reset_index()
+
+        schema_metadata = {METADATA_KEY : json.dumps({
+            'index_names' : index_names,
+            'columns' : columns.to_json(orient='split')
+        })}
+
+        partitions = data[column_names.ID] // self.partition_size
+        for partition,df_part in data.groupby(partitions):
+            part_dir = os.path.join(comp_dir,'{}={}'.format(ID_RANGE,int(partition)))
+            if not os.path.isdir(part_dir): os.makedirs(part_dir)
+            fname = os.path.join(part_dir,'part-{:05d}.parquet'.format(len(os.listdir(part_dir))))
+
+            df_part = df_part.sort_values(index_names)
+            table = pa.Table.from_pandas(df_part,preserve_index=False)
+            table = table.replace_schema_metadata(schema_metadata)
+            pq.write_table(table,fname,row_group_size=self.row_group_size)
+        return
+
+    def read(self,path,ids=None,specs=None):
+        if ids is not None: ids = pd.np.unique(ids)
+
+        fnames = self.component_files(path,ids)
+        if (len(fnames) == 0) and (ids is not None):
+            # no partition holds these ids: read no rows of every file, so the
+            # empty result still has the component's columns and index
+            fnames = self.component_files(path)
+            ids = pd.np.array([],dtype=int)
+
+        df_list = []
+        all_column_df = None
+        for fname in fnames:
+            pf = pq.ParquetFile(fname,memory_map=True)
+            index_names,column_df = _read_schema_metadata(pf)
+
+            if specs is None: col_ix = column_df.index
+            else: col_ix = column_df.index[utils.complex_row_mask(column_df,specs).values]
+            data_cols = index_names + map(str,col_ix)
+
+            row_groups = _row_groups_for_ids(pf,ids)
+            if len(row_groups) > 0:
+                table = pf.read_row_groups(row_groups,columns=data_cols)
+            else:
+                table = pf.schema.to_arrow_schema().empty_table()
+            data = table.to_pandas().loc[:,data_cols]
+
+            if ids is not None:
+                data = data[data[column_names.ID].isin(ids)]
+            data.set_index(index_names,inplace=True)
+            data.columns = col_ix
+            df_list.append(utils.reconstruct_df(data,column_df))
+
+            read_column_df = column_df.loc[col_ix].reset_index(drop=True)
+            if all_column_df is None: all_column_df = read_column_df
+            else: all_column_df = utils.union_columns(all_column_df,read_column_df)
+
+        if len(df_list) == 0: return pd.DataFrame()
+        # files appended later may have other (e.g. dummy) columns: give every
+        # file all of them, integer ones filled with 0 like HDF5Store appends
+        aligned_list = [utils.align_to_columns(df_file,all_column_df) for df_file in df_list]
+        df = pd.concat([df_file if aligned is None else aligned for df_file,aligned in zip(df_list,aligned_list)])
+        df.sort_index(inplace=True)
+        return df
+
+    def __contains__(self,path):
+        return len(self.component_files(path)) > 0
+
+    def read_manifest(self,path):
+        fname = os.path.join(self.component_dir(path),'_{}.json'.format(MANIFEST))
+        if not os.path.isfile(fname): return None
+        with open(fname) as f:
+            return json.load(f)
+
+    def write_manifest(self,path,manifest):
+        # an empty component has no files, so maybe no directory yet
+        comp_dir = self.component_dir(path)
+        if not os.path.isdir(comp_dir): os.makedirs(comp_dir)
+        fname = os.path.join(comp_dir,'_{}.json'.format(MANIFEST))
+        with open(fname,'w') as f:
+            json.dump(manifest,f)
+
+    def component_dir(self,path):
+        return os.path.join(self.root_dir,path)
+
+    def component_files(self,path,ids=None):
+        comp_dir = self.component_dir(path)
+        if not os.path.isdir(comp_dir): return []
+        partitions = None
+        if ids is not None:
+            partitions = set((pd.np.asarray(ids) // self.partition_size).tolist())
+
+        fnames = []
+        for part_dir in sorted(os.listdir(comp_dir)):
+            if not part_dir.startswith(ID_RANGE): continue
+            partition = int(part_dir.split('=')[-1])
+            if (partitions is not None) and (partition not in partitions): continue
+            part_dir = os.path.join(comp_dir,part_dir)
+            fnames += [os.path.join(part_dir,fname) for fname in sorted(os.listdir(part_dir))]
+        return fnames
+
+def _id_runs(ids,offset=0):
+    """
+    (id, start, stop) of every run of equal ids, stop exclusive
+    """
+    starts = pd.np.flatnonzero(pd.np.r_[True,ids[1:] != ids[:-1]]) if len(ids) > 0 else pd.np.array([],dtype=int)
+    stops = pd.np.r_[starts[1:],len(ids)]
+    return pd.DataFrame({
+        column_names.ID : ids[starts],
+        'start' : starts + offset,
+        'stop' : stops + offset
+    },columns=[column_names.ID,'start','stop']).astype('int64')
+
+def _range_coordinates(starts,stops):
+    """
+    All row numbers in the ranges [start, stop)
+    """
+    lengths = stops - starts
+    range_offsets = pd.np.repeat(starts - (pd.np.cumsum(lengths) - lengths),lengths)
+    return pd.np.arange(lengths.sum()) + range_offsets
+
+def _read_schema_metadata(pf):
+    info = json.loads(pf.metadata.metadata[METADATA_KEY])
+    column_df = pd.read_json(info['columns'],orient='split',dtype=False,convert_dates=False)
+    return info['index_names'],column_df
+
+def _row_groups_for_ids(pf,ids):
+    """
+    Row groups whose id statistics overlap with the sorted ids
+    """
+    meta = pf.metadata
+    if ids is None: return range(meta.num_row_groups)
+
+    id_col = [meta.schema.column(j).name for j in range(meta.num_columns)].index(column_names.ID)
+    row_groups = []
+    for rg in range(meta.num_row_groups):
+        stats = meta.row_group(rg).column(id_col).statistics
+        if (stats is None) or not stats.has_min_max:
+            row_groups.append(rg)
+            continue
+        if pd.np.searchsorted(ids,stats.min,'left') < pd.np.searchsorted(ids,stats.max,'right'):
+            row_groups.append(rg)
+    return row_groups
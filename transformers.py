@@ -4,6 +4,7 @@ import abc
 import pandas as pd
 from constants import variable_type,column_names,NO_UNITS,ALL
 import logger
+from units import rescale
 
 
 
@@ -63,54 +64,75 @@ class column_standardizer(BaseEstimator,TransformerMixin):
         col_cnt = df.columns.size
         if col_cnt == 0: return df
         names = ['component','status','variable_type','units','description']
+        defs_key = self.data_dict.definitions_key()
+        ureg_key = _ureg_key(self.ureg)
         tuples=[]
         for col_ix in range(0,col_cnt):
             col = df.iloc[:,col_ix]
-            new_col,new_name = self.standardize(col)
-            df.iloc[:,col_ix] = new_col
+            new_col,new_name = self.standardize(col,defs_key,ureg_key)
+            if new_col is not col: df.iloc[:,col_ix] = new_col
             tuples.append(map(str,new_name))
         df.columns = pd.MultiIndex.from_tuples(tuples,names=names)
         df.sort_index(axis=1, inplace=True)
         return df
 
-    def standardize(self,col):
+    def standardize(self,col,defs_key=None,ureg_key=None):
         old_col_name = col.name
         guess_component = old_col_name[0]
         units = old_col_name[-2]
         desc = old_col_name[-1]
-        dtype = col.dtype
-        defs = self.data_dict.tables.definitions
-        defs = defs[defs.component == guess_component]
-        best_def = None
-        for ix,row in defs.iterrows():
-            def_units = row['units']
-            if can_convert(def_units,units,self.ureg):
-                best_def = row
-                break
-
-        if (best_def is None) and (dtype != pd.np.object):
-            status = 'unknown'
-            var_type = variable_type.QUANTITATIVE
-        elif (best_def is None) or ((best_def['variable_type'] == variable_type.QUANTITATIVE) & (dtype == pd.np.object)):
-            status = 'unknown'
-            var_type = variable_type.NOMINAL
-            if units != NO_UNITS:
-                desc = utils.append_to_description(desc,units)
-                units = NO_UNITS
-        else:
-            status = 'known'
-            var_type = best_def['variable_type']
-            new_units = best_def['units']
-            if new_units != units:
-                if not self.ureg.same_units(units,new_units) and self.convert_units:
-                    col = self.ureg.convert_units(units,new_units,col)
-                desc = utils.append_to_description(str(desc),units)
-                units = new_units
-
-
+        if defs_key is None: defs_key = self.data_dict.definitions_key()
+        if ureg_key is None: ureg_key = _ureg_key(self.ureg)
+
+        key = (defs_key,ureg_key,guess_component,units,col.dtype.kind)
+        resolved = _COLUMN_DEFS.get(key,None)
+        if resolved is None:
+            resolved = resolve_column_def(self.data_dict.tables.definitions,self.ureg,
+                                            guess_component,units,col.dtype == pd.np.object)
+            _COLUMN_DEFS[key] = resolved
+        status,var_type,new_units,conversion = resolved
+
+        if new_units != units:
+            if (conversion is not None) and self.convert_units:
+                col = rescale(col,*conversion)
+            desc = utils.append_to_description(str(desc),units)
+            units = new_units
 
         return (col,(guess_component,status,var_type,units,desc))
 
+#(definitions key, ureg key, component, units, dtype kind) -> resolve_column_def(...)
+_COLUMN_DEFS = {}
+
+def _ureg_key(ureg):
+    #registries without a fingerprint are only known by their identity
+    if hasattr(ureg,'fingerprint'): return ureg.fingerprint()
+    return (type(ureg).__name__,id(ureg))
+
+def resolve_column_def(definitions,ureg,component,units,is_object):
+    """
+    (status, variable_type, units, conversion) of a column with these
+    component, units and dtype: the first definition of the component with
+    convertible units is used. conversion is the (scale, offset) to the
+    definition's units, None if there is nothing to convert.
+    """
+    defs = definitions[definitions.component == component]
+    best_def = None
+    for def_units,def_var_type in zip(defs['units'],defs['variable_type']):
+        if can_convert(def_units,units,ureg):
+            best_def = (def_units,def_var_type)
+            break
+
+    if (best_def is None) and not is_object:
+        return ('unknown',variable_type.QUANTITATIVE,units,None)
+    elif (best_def is None) or ((best_def[1] == variable_type.QUANTITATIVE) & is_object):
+        return ('unknown',variable_type.NOMINAL,NO_UNITS,None)
+
+    new_units,var_type = best_def
+    conversion = None
+    if (new_units != units) and not ureg.same_units(units,new_units):
+        conversion = ureg.conversion_factors(units,new_units)
+    return ('known',var_type,new_units,conversion)
+
 def can_convert(unit1,unit2,med_ureg):
     if (unit1 == unit2): return True
     if (NO_UNITS in [unit1,unit2]): return False
@@ -125,53 +147,66 @@ class oob_value_remover(BaseEstimator,TransformerMixin):
 
     def transform(self, df):
         logger.log('Drop OOB data | {}'.format(df.shape),new_level=True)
+        if not df.columns.is_monotonic_increasing: df = df.sort_index(axis=1)
+        if not df.index.is_monotonic_increasing: df = df.sort_index()
         df = df.copy()
-        idx = pd.IndexSlice
-        df = df.sort_index(axis=1).sort_index()
-        for component in df.columns.get_level_values('component').unique().tolist():
-            component_defs = self.data_dict.defs_for_component(component)
-            for units in df[component].columns.get_level_values(column_names.UNITS).unique().tolist():
-                df_slice = df.loc[:,idx[component,:,:,units,:]]
-                logger.log('{}, {}, {}'.format(component,units,df_slice.count().sum()))
-                matching_defs = component_defs[(component_defs.units == units)]
-                if matching_defs.empty: continue
-                def_row = matching_defs.iloc[0]
-                lower = def_row['lower']
-                upper = def_row['upper']
-                df.loc[:,idx[component,:,:,units,:]] = remove_oob_values(df_slice,lower,upper)
+
+        lower,upper = column_bounds(df.columns,self.data_dict.bounds_table())
+        is_numeric = (df.dtypes.apply(lambda dtype: dtype.kind in 'iuf')).values
+        cols = pd.np.flatnonzero(is_numeric & ~(pd.isnull(lower) & pd.isnull(upper)))
+        if len(cols) > 0:
+            values = df.iloc[:,cols].values.astype(float)
+            with pd.np.errstate(invalid='ignore'):
+                oob_mask = (values < lower[cols]) | (values > upper[cols])
+            has_oob = oob_mask.any(axis=0)
+            logger.log('{} values out of bounds in {} columns'.format(oob_mask.sum(),has_oob.sum()))
+            for ix in pd.np.flatnonzero(has_oob):
+                df.iloc[:,cols[ix]] = pd.np.where(oob_mask[:,ix],pd.np.nan,values[:,ix])
         df.dropna(how='all',inplace=True,axis=1)
         logger.end_log_level()
         return df
 
-def remove_oob_values(data,lower,upper):
-    oob_mask = (data < lower) | (data > upper)
-    return data[~oob_mask]
+def column_bounds(columns,bounds):
+    """
+    Arrays of the lower and upper bounds (a data_dictionary.bounds_table) of
+    each column's component and units, NaN if there are none
+    """
+    col_keys = pd.MultiIndex.from_arrays([columns.get_level_values(column_names.COMPONENT),
+                                            columns.get_level_values(column_names.UNITS)])
+    bounds = bounds.reindex(col_keys)
+    return bounds['lower'].values.astype(float),bounds['upper'].values.astype(float)
 
 
 
 
 class split_dtype(BaseEstimator,TransformerMixin):
+    """
+    Values of a column that can't be parsed as numbers are moved to a
+    nominal (no_units) column of their own
+    """
 
     def fit(self, x, y=None):
         return self
 
     def transform(self, df):
         if df.empty: return df
-        df_numeric  = df.apply(pd.to_numeric,errors='coerce')
-        is_string = pd.isnull(df_numeric) & ~pd.isnull(df)
-
-        df_string = df[is_string].dropna(how='all')
-        tuples = [(col_name[0],NO_UNITS,utils.append_to_description(*map(str,col_name[3:0:-1]))) for col_name in df_string.columns]
-        df_string.columns = pd.MultiIndex.from_tuples(tuples,names = df_string.columns.names)
-        df_string = utils.add_same_val_index_level(df_string,level_val='string',level_name='dtype',axis=1)
-
-        df_numeric = df_numeric.dropna(how='all')
-        df_numeric = utils.add_same_val_index_level(df_numeric,level_val='number',level_name='dtype',axis=1)
-
-        df_joined = df_numeric.join(df_string,how='outer')
-        del df_string,df_numeric
-
-        df_joined.columns = df_joined.columns.droplevel('dtype')
+        numeric_cols = []
+        string_cols = []
+        for ix in range(df.shape[1]):
+            col = df.iloc[:,ix]
+            numeric = pd.to_numeric(col,errors='coerce')
+            numeric_cols.append(numeric)
+            if numeric.dtype.kind not in 'fc': continue
+            is_string = numeric.isnull().values & col.notnull().values
+            if not is_string.any(): continue
+            col_name = col.name
+            string_col = col.where(is_string)
+            string_col.name = (col_name[0],NO_UNITS,utils.append_to_description(*map(str,col_name[3:0:-1])))
+            string_cols.append(string_col)
+
+        df_joined = pd.concat(numeric_cols + string_cols,axis=1)
+        df_joined.columns = pd.MultiIndex.from_tuples([col.name for col in numeric_cols + string_cols],names=df.columns.names)
+        df_joined.dropna(how='all',inplace=True)
         df_joined.dropna(how='all',inplace=True,axis=1)
         return df_joined
 
@@ -201,33 +236,38 @@ class combine_like_cols(BaseEstimator,TransformerMixin):
     def transform(self, df):
         logger.log('TRANSFORM Combine like columns {}'.format(df.shape),new_level=True)
 
-        column_list = []
+        # coalesce each group, in order of priority: the first non-null value
+        # wins. Since we sort the max col first in fit, we will be prioritizing
+        # all values from the max value column. Although this may be a change in
+        # style from previous, it is easy, and will most of the time be RIGHT.
+        combined_names = []
+        combined_values = []
+        to_drop = set()
         for index,columns in self.columns_to_combine.iteritems():
             logger.log(index)
-            df_list=[]
+            values = None
             for col_name in columns:
-                if col_name not in df.columns:
-                    df[col_name] = pd.np.nan
-                col = df[col_name].dropna()
-                col.name = index + (ALL,)
-                df_list.append(col)
+                if col_name not in df.columns: continue
+                to_drop.add(col_name)
+                col_values = df[col_name].values
+                if values is None:
+                    values = col_values.copy()
+                    continue
+                if values.dtype != col_values.dtype:
+                    values = values.astype(pd.np.result_type(values.dtype,col_values.dtype))
+                to_fill = pd.isnull(values) & ~pd.isnull(col_values)
+                values[to_fill] = col_values[to_fill]
+            if values is None: values = pd.np.full(df.shape[0],pd.np.nan)
+            combined_names.append(index + (ALL,))
+            combined_values.append(values)
+
+        df_kept = df.loc[:,[col_name not in to_drop for col_name in df.columns]]
+        if len(combined_names) > 0:
+            df_combined = pd.DataFrame(dict(enumerate(combined_values)),index=df.index,columns=range(len(combined_values)))
+            df_combined.columns = pd.MultiIndex.from_tuples(combined_names,names=df.columns.names)
+            df = pd.concat([df_kept,df_combined],axis=1)
+        else: df = df_kept.copy()
 
-            df_combined = pd.concat(df_list).to_frame()
-
-            # Here we will drop all duplicate values; since we sort the max col first,
-            # BEFORE we loop and combine, we will be prioritizing all values from the max value
-            # column. Although this may be a change in style from previous, it is easy, and will
-            # most of the time be RIGHT.
-            duplicates_to_drop = df_combined.index.duplicated(keep='first')
-            df_combined = df_combined.loc[~duplicates_to_drop]
-
-            #drop the combined columns
-            df.drop(columns,axis=1,inplace=True)
-
-            #join the combined column back to the DF
-            df = df.join(df_combined,how='outer')
-
-        df.columns.names = df.columns.names
         df.sort_index(inplace=True)
         df.sort_index(inplace=True,axis=1)
 
@@ -263,22 +303,32 @@ class standardize_categories(BaseEstimator,TransformerMixin):
         return self
 
     def transform(self, df):
-        for component in utils.get_components(df):
+        mappings = self.category_mappings(utils.get_components(df))
+        col_ixs = categorical_columns(df,mappings.keys())
+        if len(col_ixs) == 0: return df
+
+        new_values = {}
+        for ix in col_ixs:
+            mapping = mappings[df.columns[ix][0]]
+            new_values[ix] = map_categories(df.iloc[:,ix].values,mapping)
+        return with_columns(df,new_values)
+
+    def category_mappings(self,components):
+        """
+        component -> {value : standard category value}
+        """
+        df_categories = self.data_dict.tables.categories
+        col = 'val_numeric' if self.use_numeric else 'val_text'
+        mappings = {}
+        for component in components:
             cat_map = self.category_map.get(component,None)
             if cat_map is None: continue
-            df_slice = df.loc[:,[component]]
-            categorical_mask = df_slice.columns.get_level_values('variable_type').isin([variable_type.NOMINAL,variable_type.ORDINAL])
-            df_categories = self.data_dict.tables.categories
-            to_replace = cat_map.keys()
-            col = 'val_numeric' if self.use_numeric else 'val_text'
-            values = [df_categories.loc[cat_ix,col] for cat_ix in cat_map.values()]
-
-            df_slice.loc[:,categorical_mask] = df_slice.loc[:,categorical_mask].replace(to_replace=to_replace,value=values)
+            mapping = {text : df_categories.loc[cat_ix,col] for text,cat_ix in cat_map.iteritems()}
             if not self.use_numeric:
-                to_replace = [df_categories.loc[cat_ix,'val_numeric'] for cat_ix in cat_map.values()]
-                df_slice.loc[:,categorical_mask] = df_slice.loc[:,categorical_mask].replace(to_replace=to_replace,value=values)
-            df.loc[:,[component]] = df_slice
-        return df
+                for cat_ix in cat_map.values():
+                    mapping[df_categories.loc[cat_ix,'val_numeric']] = df_categories.loc[cat_ix,col]
+            mappings[component] = mapping
+        return mappings
 
 class split_bad_categories(BaseEstimator,TransformerMixin):
 
@@ -290,32 +340,92 @@ class split_bad_categories(BaseEstimator,TransformerMixin):
         return self
 
     def transform(self, df):
+        col = 'val_numeric' if self.use_numeric else 'val_text'
+        valid_values = {}
         for component in utils.get_components(df):
             df_categories = self.data_dict.get_categories(component)
             if df_categories is None: continue
-            df_slice = df.loc[:,[component]]
-            col = 'val_numeric' if self.use_numeric else 'val_text'
-            valid_values = df_categories.loc[:,col]
-
-            categorical_mask = df_slice.columns.get_level_values('variable_type').isin([variable_type.NOMINAL,variable_type.ORDINAL])
-            categorical_slice = df_slice.loc[:,categorical_mask]
-
-            df_valid_mask  = categorical_slice.apply(lambda x: x.isin(valid_values))
-
-            df_slice.loc[:,categorical_mask] = categorical_slice[df_valid_mask]
-            df.loc[:,[component]] = df_slice
-
-            df_invalid = categorical_slice[~df_valid_mask]
-            df_invalid.columns = utils.set_level_to_same_val(df_invalid.columns,'status','unknown')
-            df_invalid.columns = utils.set_level_to_same_val(df_invalid.columns,'variable_type',variable_type.NOMINAL)
-            df = df.join(df_invalid,how='outer')
-            del df_invalid
+            valid_values[component] = df_categories.loc[:,col].values
+
+        new_values = {}
+        invalid_values = []
+        invalid_names = []
+        for ix in categorical_columns(df,valid_values.keys()):
+            col_name = df.columns[ix]
+            values = df.iloc[:,ix].values
+            codes,uniques = pd.factorize(values)
+            is_valid_unique = pd.np.r_[pd.Series(uniques).isin(valid_values[col_name[0]]).values,False]
+            is_valid = is_valid_unique.take(codes)
+
+            new_values[ix] = pd.np.where(is_valid,values,pd.np.nan)
+            invalid_values.append(pd.np.where(is_valid,pd.np.nan,values))
+            invalid_names.append(col_name)
+        if len(new_values) == 0: return df.dropna(how='all',axis=1)
+
+        invalid_columns = pd.MultiIndex.from_tuples(invalid_names,names=df.columns.names)
+        invalid_columns = utils.set_level_to_same_val(invalid_columns,'status','unknown')
+        invalid_columns = utils.set_level_to_same_val(invalid_columns,'variable_type',variable_type.NOMINAL)
+        df = with_columns(df,new_values,zip(invalid_columns,invalid_values))
         df.dropna(how='all',inplace=True,axis=1)
         return df
 
+def categorical_columns(df,components):
+    """
+    Positions of the nominal and ordinal columns of the components
+    """
+    is_categorical = df.columns.get_level_values('variable_type').isin([variable_type.NOMINAL,variable_type.ORDINAL])
+    in_components = df.columns.get_level_values('component').isin(components)
+    return pd.np.flatnonzero(is_categorical & in_components)
+
+def map_categories(values,mapping):
+    """
+    values with each key of mapping replaced by its value. Only the distinct
+    values are looked up, the result is a take of their factorized codes.
+    """
+    codes,uniques = pd.factorize(values)
+    # code -1 (null) takes the trailing NaN
+    mapped_uniques = pd.np.array([mapping.get(value,value) for value in uniques] + [pd.np.nan],dtype=object)
+    return pd.Series(mapped_uniques.take(codes)).infer_objects().values
+
+def with_columns(df,new_values,added=[]):
+    """
+    df with the columns at the positions in new_values replaced by those
+    values, and the (name, values) in added appended, built in one concat
+    """
+    cols = []
+    for ix in range(df.shape[1]):
+        if ix in new_values: cols.append(pd.Series(new_values[ix],index=df.index))
+        else: cols.append(df.iloc[:,ix])
+    cols += [pd.Series(values,index=df.index) for _,values in added]
+    df_out = pd.concat(cols,axis=1)
+    df_out.columns = df.columns.append(pd.MultiIndex.from_tuples([name for name,_ in added],names=df.columns.names)) \
+                        if len(added) > 0 else df.columns
+    return df_out
+
 class nominal_to_onehot(BaseEstimator,TransformerMixin):
+    """
+    One dummy column per value seen in fit for each nominal column. Values
+    not seen in fit get no dummy, so frames transformed by the same fitted
+    encoder have the same columns. Dummies are dense uint8: sparse columns
+    break count() and dropna() in the later cleaners and can't be stored.
+    """
 
-    def fit(self, x, y=None):
+    def fit(self, df, y=None):
+        self.vocabulary_ = {}
+        nominal_cols = df.columns.get_level_values('variable_type') == variable_type.NOMINAL
+        for col_name in df.loc[:,nominal_cols]:
+            self.vocabulary_[col_name] = sorted(df[col_name].dropna().unique().tolist())
+        return self
+
+    def partial_fit(self, df, y=None):
+        """
+        Like fit, but the values learned before stay in the vocabulary, e.g.
+        to encode the chunks of one component alike
+        """
+        vocabulary = getattr(self,'vocabulary_',{})
+        self.fit(df)
+        for col_name,values in vocabulary.iteritems():
+            self.vocabulary_[col_name] = sorted(set(values) | set(self.vocabulary_.get(col_name,[])))
         return self
 
     def transform(self, df):
@@ -323,15 +433,28 @@ class nominal_to_onehot(BaseEstimator,TransformerMixin):
 
         logger.log('Nominal to OneHot',new_level=True)
         nominal_cols = df.columns.get_level_values('variable_type') == variable_type.NOMINAL
-
-        for col_name in df.loc[:,nominal_cols]:
-            column = df[col_name]
-            df.drop(col_name,axis=1,inplace=True)
-            df_dummies = pd.get_dummies(column)
-            if df_dummies.empty: continue
-            dummy_col_names = [col_name[:-1] + ('{}_{}'.format(col_name[-1],text),) for text in df_dummies.columns]
-            df_dummies.columns = pd.MultiIndex.from_tuples(dummy_col_names,names=df.columns.names)
-            df = df.join(df_dummies,how='outer')
+        nominal_names = df.columns[nominal_cols].tolist()
+
+        #all dummies are written into one matrix
+        vocabularies = [self.vocabulary_.get(col_name,[]) for col_name in nominal_names]
+        offsets = pd.np.r_[0,pd.np.cumsum(map(len,vocabularies))].astype(int)
+        dummies = pd.np.zeros((df.shape[0],offsets[-1]),dtype=pd.np.uint8)
+        dummy_col_names = []
+        for ix,(col_name,vocabulary) in enumerate(zip(nominal_names,vocabularies)):
+            if len(vocabulary) == 0: continue
+            codes = pd.Index(vocabulary).get_indexer(df[col_name].values)
+            rows = pd.np.flatnonzero(codes >= 0)
+            dummies[rows,offsets[ix] + codes[rows]] = 1
+            dummy_col_names += [col_name[:-1] + ('{}_{}'.format(col_name[-1],text),) for text in vocabulary]
+
+        if len(dummy_col_names) == 0:
+            logger.end_log_level()
+            return df.loc[:,~nominal_cols]
+
+        df_dummies = pd.DataFrame(dummies,index=df.index)
+        df_dummies.columns = pd.MultiIndex.from_tuples(dummy_col_names,names=df.columns.names)
+
+        df = pd.concat([df.loc[:,~nominal_cols],df_dummies],axis=1)
         logger.end_log_level()
         return df
 
@@ -341,6 +464,18 @@ Duplicate index aggregators
 """
 
 class same_index_aggregator(BaseEstimator,TransformerMixin):
+    """
+    Aggregates the rows that share an index value.
+
+    agg_func: one of REDUCERS, which run as cythonized groupby reductions
+        (NaNs skipped, like pandas), or a callable applied to each column of
+        each group, which is much slower
+
+    Rows with a NaN in their index can't be grouped, they are returned
+    unaggregated.
+    """
+
+    REDUCERS = ['first','last','mean','max','min','median']
 
     def __init__(self,agg_func):
         self.agg_func = agg_func
@@ -349,7 +484,22 @@ class same_index_aggregator(BaseEstimator,TransformerMixin):
         return self
 
     def transform(self, df):
+        if not df.index.has_duplicates: return df.sort_index()
+
+        #groupby would drop rows with a NaN in their index, both paths keep them as they are
+        nan_keys = df.index.to_frame(index=False).isnull().any(axis=1).values
+        if not nan_keys.any(): return self.__aggregate(df)
+        df_no_dups = pd.concat([self.__aggregate(df[~nan_keys]),df[nan_keys]])
+        df_no_dups.sort_index(inplace=True)
+        return df_no_dups
+
+    def __aggregate(self, df):
+        if not df.index.has_duplicates: return df.sort_index()
+
+        if self.agg_func in self.REDUCERS:
+            return getattr(df.groupby(level=df.index.names,sort=True),self.agg_func)()
 
+        #python calls are slow, only make them for the duplicated rows
         duplicated = df.index.duplicated(keep=False)
 
         df_safe = df[~duplicated]
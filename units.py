@@ -1,28 +1,58 @@
+import os
+import hashlib
+import pint
 from pint import UnitRegistry
 from pint.unit import UnitsContainer
+from collections import OrderedDict
 import pandas as pd
 
+MEDICAL_UOM_DEFS = 'config/medical_units.txt'
+
+_UREGS = {}
+
 class MedicalUreg(UnitRegistry):
 
-    def __init__(self,medical_uom_defs='config/medical_units.txt',**kwargs):
+    def __init__(self,medical_uom_defs=MEDICAL_UOM_DEFS,cache_size=1024,**kwargs):
         super(MedicalUreg, self).__init__(**kwargs)
         self.load_definitions(medical_uom_defs)
+        self.medical_uom_defs = medical_uom_defs
+        self._parsed_units_lru = LRUCache(cache_size)
+        self._dimensionality_lru = LRUCache(cache_size)
+        self._conversion_lru = LRUCache(cache_size)
+
+    def fingerprint(self):
+        """
+        Hash of the definitions and pint version the registry was built from
+        """
+        with open(self.medical_uom_defs,'rb') as f:
+            return hashlib.md5(f.read() + pint.__version__).hexdigest()
 
     def parse_units(self,units):
+        return self._parsed_units_lru.get(units,lambda: self.__parse_units(units))
+
+    def __parse_units(self,units):
         try:
             parsed_units = super(MedicalUreg,self).parse_units(units)
         except:
             parsed_units = super(MedicalUreg,self).parse_units(units.lower())
         return parsed_units
 
+    def dimensionality(self,units):
+        return self._dimensionality_lru.get(units,lambda: self.parse_units(units).dimensionality)
+
     def same_units(self,unit1,unit2):
         return same_units(unit1,unit2,self)
 
     def same_dimensionality(self,unit1,unit2):
-        return same_dimensionality(unit1,unit2,self)
+        return self.dimensionality(unit1) == self.dimensionality(unit2)
+
+    def conversion_factors(self,from_units,to_units):
+        key = (from_units,to_units)
+        return self._conversion_lru.get(key,lambda: conversion_factors(from_units,to_units,self))
 
     def convert_units(self,from_units,to_units,data):
-        return convert_units(from_units,to_units,data,self)
+        scale,offset = self.conversion_factors(from_units,to_units)
+        return rescale(data,scale,offset)
 
     def is_volume(self,units):
         if type(units) is str:
@@ -45,6 +75,29 @@ class MedicalUreg(UnitRegistry):
         return units.dimensionality.get('[time]',0) == -1.0
 
 
+def get_ureg(medical_uom_defs=MEDICAL_UOM_DEFS):
+    """
+    The process-wide MedicalUreg for medical_uom_defs, built on first use.
+    Registries can't be pickled, so each process builds its own once, unless
+    it is forked from one that already has (see prewarm).
+    """
+    key = os.path.abspath(medical_uom_defs)
+    if key not in _UREGS: _UREGS[key] = MedicalUreg(medical_uom_defs)
+    return _UREGS[key]
+
+def prewarm(units_list=[],medical_uom_defs=MEDICAL_UOM_DEFS):
+    """
+    Build the shared registry and parse units_list before forking workers,
+    so that they inherit it ready to use
+    """
+    ureg = get_ureg(medical_uom_defs)
+    for units in units_list:
+        try:
+            ureg.dimensionality(units)
+        except Exception:
+            continue
+    return ureg
+
 def smart_parse_units(units,ureg):
     try:
         parsed_units = ureg.parse_units(units)
@@ -60,12 +113,25 @@ def same_dimensionality(unit1,unit2,ureg):
     return ureg.parse_units(unit1).dimensionality == ureg.parse_units(unit2).dimensionality
 
 def convert_units(from_units,to_units,data,ureg):
+    scale,offset = conversion_factors(from_units,to_units,ureg)
+    return rescale(data,scale,offset)
+
+def conversion_factors(from_units,to_units,ureg):
+    """
+    (scale, offset) so that converted = data*scale + offset. Every pint
+    conversion is affine, offset units like degF -> degC included.
+    """
     from_parsed = ureg.parse_units(from_units)
     to_parsed = ureg.parse_units(to_units)
     Q_ = ureg.Quantity
-    unit_data = Q_(data,from_parsed)
-    np_ar = unit_data.to(to_parsed)
-    return pd.Series(np_ar,name=np_ar.name,index=data.index)
+    offset = Q_(0.0,from_parsed).to(to_parsed).magnitude
+    scale = Q_(1.0,from_parsed).to(to_parsed).magnitude - offset
+    return scale,offset
+
+def rescale(data,scale,offset=0):
+    values = data.values * scale
+    if offset != 0: values = values + offset
+    return pd.Series(values,name=data.name,index=data.index)
 
 
 def is_volume(units):
@@ -73,3 +139,21 @@ def is_volume(units):
 
 def is_mass(units):
     return units.dimensionality == UnitsContainer({'[mass]':1.0})
+
+class LRUCache(object):
+
+    def __init__(self,maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def get(self,key,make_value):
+        """
+        Cached value for key, calling make_value() on a miss
+        """
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            value = make_value()
+            if len(self.data) >= self.maxsize: self.data.popitem(last=False)
+        self.data[key] = value
+        return value
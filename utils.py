@@ -1,9 +1,14 @@
 import sqlalchemy
+import threading
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
 import pandas as pd
 from constants import variable_type,column_names,ALL
 import logger
 import numpy as np
-import dask.dataframe as dd
+
+_HDF5_LOCK = threading.RLock()
 
 
 def psql_connect(user, password, database='postgres', host='localhost', port=5432):
@@ -45,13 +50,15 @@ class Bunch(object):
         self.__dict__.update(kwds)
 
 def add_subindex(df,subindex_name):
+    """
+    Appends an index level numbering the rows of each duplicated index
+    entry 0,1,2,... (0 for unique entries)
+    """
     df = df.sort_index()
-    index = df.index
-    df[subindex_name] = range(0,len(index))
-    duplicated = index.duplicated(keep=False)
-    df.loc[duplicated,subindex_name] = df.loc[duplicated].groupby(level=index.names)[subindex_name].apply(lambda x:x - x.min())
-    df.loc[~duplicated,subindex_name] = 0
-    df.loc[:,subindex_name] = df.loc[:,subindex_name].astype(int)
+    #after sorting, duplicates are adjacent: count rows since each run's first row
+    positions = np.arange(len(df.index))
+    run_starts = np.where(~df.index.duplicated(keep='first'),positions,0)
+    df[subindex_name] = positions - np.maximum.accumulate(run_starts)
     df.set_index(subindex_name, append=True,inplace=True)
     return df
 
@@ -143,12 +150,18 @@ def smart_count(col):
 Pytables/HDF5 I/O with axis deconstruction
 """
 
-def read_and_reconstruct(hdf5_fname,path,where=None):
+def read_and_reconstruct(hdf5_fname,path,where=None,specs=None,start=None,stop=None):
     # Get all paths for dataframes in store
     data_path,col_path = deconstucted_paths(path)
 
-    data = pd.read_hdf(hdf5_fname,data_path,where=where)
     columns = pd.read_hdf(hdf5_fname,col_path)
+
+    # only read the columns that match the specs
+    data_columns = None
+    if specs is not None:
+        data_columns = columns.index[complex_row_mask(columns,specs).values].tolist()
+
+    data = pd.read_hdf(hdf5_fname,data_path,where=where,columns=data_columns,start=start,stop=stop)
     return reconstruct_df(data,columns)
 
 
@@ -167,22 +180,124 @@ def reconstruct_columns(column_df,col_ix=None):
 
     return pd.MultiIndex.from_arrays(col_arys,names=levels)
 
-def deconstruct_and_write(df,hdf5_fname,path,append=False):
-
-    # Deconstruct the dataframe
-    data,columns = deconstruct_df(df)
+def deconstruct_and_write(df,hdf5_fname,path,append=False,chunksize=500000):
+    """
+    chunksize: rows of the stored table copied at a time, if appending df
+        needs the table to be rewritten with more columns
+    """
 
     # Get all paths for dataframes in store
     data_path,col_path = deconstucted_paths(path)
 
     #Open store and save df
     store = pd.HDFStore(hdf5_fname)
-    store.put(data_path,data,append=append,format='t')
-    if (not append) or col_path not in store:
-        columns.to_hdf(hdf5_fname,col_path,format='t')
-    store.close()
+    try:
+        if append and (col_path in store):
+            # line the new rows up with the columns that are already stored
+            aligned = align_to_columns(df,store[col_path])
+            if aligned is not None:
+                data,columns = deconstruct_df(aligned)
+                try:
+                    store.append(data_path,data)
+                    return
+                except ValueError:
+                    # e.g. strings longer than the stored column allows
+                    pass
+            # the new rows don't fit the stored table, rewrite it with every column
+            rewrite_with_rows(store,path,df,chunksize)
+            return
+
+        # Deconstruct the dataframe
+        data,columns = deconstruct_df(df)
+        store.put(data_path,data,append=append,format='t')
+        store.put(col_path,columns,format='t')
+    finally:
+        store.close()
     return
 
+def rewrite_with_rows(store,path,df,chunksize=500000):
+    """
+    Rewrite the deconstructed table at path with the columns of both the
+    stored rows and df, then append df. The stored rows are copied
+    chunksize at a time, and get 0 in the integer (e.g. dummy) columns
+    they lack.
+    """
+    data_path,col_path = deconstucted_paths(path)
+    rewrite_path = '{}/{}'.format(path,'data_rewrite')
+    if rewrite_path in store: store.remove(rewrite_path)
+
+    stored_column_df = store[col_path]
+    _,new_column_df = deconstruct_df(df.iloc[:0])
+    column_df = union_columns(stored_column_df,new_column_df)
+    min_itemsize = _string_itemsize(store,data_path,df)
+
+    def append_rows(rows):
+        aligned = align_to_columns(rows,column_df)
+        if aligned is None: raise ValueError('rows can not be cast to the columns of {}'.format(path))
+        data,_ = deconstruct_df(aligned)
+        store.append(rewrite_path,data,min_itemsize=min_itemsize)
+
+    nrows = store.get_storer(data_path).nrows
+    for start in range(0,nrows,chunksize):
+        append_rows(reconstruct_df(store.select(data_path,start=start,stop=start+chunksize),stored_column_df))
+    append_rows(df)
+
+    store.remove(data_path)
+    store.get_node(rewrite_path)._f_rename(data_path.split('/')[-1])
+    store.put(col_path,column_df,format='t')
+
+def union_columns(column_df,new_column_df):
+    """
+    Deconstructed columns with the columns of new_column_df that column_df
+    lacks added at the end, and the dtypes of the shared ones widened to
+    fit both
+    """
+    levels = column_df.columns.drop('dtype').tolist()
+    known = pd.MultiIndex.from_arrays(column_df.loc[:,levels].astype(str).T.values)
+    codes = known.get_indexer(pd.MultiIndex.from_arrays(new_column_df.loc[:,levels].astype(str).T.values))
+    column_df = column_df.copy()
+    for code,dtype in zip(codes[codes >= 0],new_column_df['dtype'].values[codes >= 0]):
+        try:
+            column_df.at[code,'dtype'] = str(np.result_type(np.dtype(column_df.at[code,'dtype']),np.dtype(dtype)))
+        except TypeError:
+            column_df.at[code,'dtype'] = 'object'
+    return pd.concat([column_df,new_column_df.loc[codes == -1]],ignore_index=True)
+
+def _string_itemsize(store,data_path,df):
+    """
+    min_itemsize that fits both the stored strings and the strings of df
+    """
+    coldtypes = store.get_storer(data_path).table.coldtypes
+    sizes = [dtype.itemsize for dtype in coldtypes.values() if dtype.kind == 'S']
+    for ix in np.flatnonzero((df.dtypes == object).values):
+        sizes.append(df.iloc[:,ix].str.len().max())
+    sizes = [int(size) for size in sizes if pd.notnull(size)]
+    if len(sizes) == 0: return None
+    return {'values':max(sizes)}
+
+def align_to_columns(df,column_df):
+    """
+    Reorder df to the deconstructed columns, adding the missing ones with
+    their stored dtype. Returns None if df has columns that are not stored or
+    values that can't be cast to the stored dtypes.
+    """
+    columns = reconstruct_columns(column_df)
+    if len(df.columns.difference(columns)) > 0: return None
+    aligned = df.reindex(columns=columns)
+    missing = ~columns.isin(df.columns)
+    col_list = []
+    try:
+        for ix,dtype in enumerate(column_df['dtype']):
+            dtype = np.dtype(dtype)
+            col = aligned.iloc[:,ix]
+            if missing[ix] and dtype.kind in 'iub': col = col.fillna(0)
+            col_list.append(col.astype(dtype))
+    except (ValueError,TypeError):
+        return None
+    aligned = pd.concat(col_list,axis=1)
+    aligned.columns = columns
+    return aligned
+
 def deconstruct_df(df):
     columns = pd.DataFrame(map(list,df.columns.tolist()),columns=df.columns.names)
     columns['dtype'] = df.dtypes.values.astype(str)
@@ -190,6 +305,147 @@ def deconstruct_df(df):
     data.columns = [i for i in range(df.shape[1])]
     return data,columns
 
+"""
+Long format: one row per non-null cell
+"""
+
+def to_long(df,column_df=None):
+    """
+    Wide df -> (df_long, df_text, column_df). Both long frames have df's
+    index and a row of (column_code, value) per cell; the code is the row
+    of the column in column_df. Numeric cells go to df_long as floats,
+    leaving out NaNs and the zeros of integer (e.g. dummy) columns, and
+    text cells go to df_text. Rows without a numeric cell get one with
+    code -1, so df_long has every row of df. Columns already in the passed
+    column_df keep their code, new ones are added to it.
+    """
+    data,new_column_df = deconstruct_df(df)
+    if column_df is None:
+        column_df = new_column_df
+        codes = np.arange(len(column_df))
+    else:
+        levels = column_df.columns.drop('dtype').tolist()
+        known = pd.MultiIndex.from_arrays(column_df.loc[:,levels].astype(str).T.values)
+        codes = known.get_indexer(pd.MultiIndex.from_arrays(new_column_df.loc[:,levels].astype(str).T.values))
+        is_new = codes == -1
+        codes[is_new] = np.arange(is_new.sum()) + len(column_df)
+        column_df = pd.concat([column_df,new_column_df.loc[is_new]],ignore_index=True)
+
+    kinds = np.array([np.dtype(dtype).kind for dtype in new_column_df['dtype']],dtype=object)
+    if (~np.in1d(kinds,list('iubfO'))).any():
+        raise ValueError('the long format only stores numeric and text columns, not {}'.format(
+                                df.columns[~np.in1d(kinds,list('iubfO'))].tolist()))
+    is_text = kinds == 'O'
+
+    values = data.iloc[:,np.flatnonzero(~is_text)].values.astype(float)
+    is_int = np.in1d(kinds[~is_text],list('iub'))
+    rows,cols = np.nonzero(~np.isnan(values) & ~(is_int & (values == 0)))
+    empty_rows = np.setdiff1d(np.arange(len(df.index)),rows)
+    order = np.argsort(np.r_[rows,empty_rows],kind='mergesort')
+    df_long = _long_frame(df.index,
+                            np.r_[rows,empty_rows][order],
+                            np.r_[codes[~is_text][cols],-np.ones(len(empty_rows),dtype=int)][order],
+                            np.r_[values[rows,cols],np.nan*np.ones(len(empty_rows))][order])
+
+    text = data.iloc[:,np.flatnonzero(is_text)].values
+    rows,cols = np.nonzero(pd.notnull(text))
+    df_text = _long_frame(df.index,rows,codes[is_text][cols],text[rows,cols])
+    return df_long,df_text,column_df
+
+def _long_frame(index,rows,codes,values):
+    return pd.DataFrame({
+        column_names.COLUMN_CODE : np.asarray(codes,dtype=int),
+        column_names.VALUE : values
+    },index=index.take(rows),columns=[column_names.COLUMN_CODE,column_names.VALUE])
+
+def to_wide(df_long,column_df,df_text=None,col_ix=None):
+    """
+    Inverse of to_long: every row of df_long, with the columns col_ix
+    (default all of column_df) in their stored dtypes. Integer columns are
+    0 where they have no cell.
+    """
+    if col_ix is None: col_ix = column_df.index
+    col_ix = pd.Index(col_ix)
+    rows = df_long.index.drop_duplicates()
+
+    values = np.nan*np.ones((len(rows),len(col_ix)))
+    cells = df_long[df_long[column_names.COLUMN_CODE].isin(col_ix)]
+    values[rows.get_indexer(cells.index),col_ix.get_indexer(cells[column_names.COLUMN_CODE].values)] = cells[column_names.VALUE].values
+
+    dtypes = [np.dtype(dtype) for dtype in column_df.loc[col_ix,'dtype']]
+    if any(dtype.kind == 'O' for dtype in dtypes):
+        text = np.empty((len(rows),len(col_ix)),dtype=object)
+        text[:] = np.nan
+        if df_text is not None:
+            row_pos = rows.get_indexer(df_text.index)
+            col_pos = col_ix.get_indexer(df_text[column_names.COLUMN_CODE].values)
+            keep = (row_pos >= 0) & (col_pos >= 0)
+            text[row_pos[keep],col_pos[keep]] = df_text[column_names.VALUE].values[keep]
+
+    data = {}
+    for ix,dtype in enumerate(dtypes):
+        if dtype.kind == 'O': data[ix] = text[:,ix]
+        elif dtype.kind in 'iub': data[ix] = np.where(np.isnan(values[:,ix]),0,values[:,ix]).astype(dtype)
+        else: data[ix] = values[:,ix].astype(dtype)
+    data = pd.DataFrame(data,index=rows,columns=range(len(col_ix)))
+    data.columns = col_ix
+    return reconstruct_df(data,column_df)
+
+def write_long(df,hdf5_fname,path,append=False):
+    data_path,col_path = deconstucted_paths(path)
+    text_path = '{}/{}'.format(path,'text')
+    store = pd.HDFStore(hdf5_fname)
+    try:
+        column_df = store[col_path] if append and (col_path in store) else None
+        df_long,df_text,column_df = to_long(df,column_df)
+        store.put(data_path,df_long,append=append,format='t')
+        if not append and (text_path in store): store.remove(text_path)
+        if not df_text.empty:
+            try:
+                store.append(text_path,df_text)
+            except ValueError:
+                # longer strings than the stored ones
+                store.put(text_path,pd.concat([store[text_path],df_text]),format='t')
+        store.put(col_path,column_df,format='t')
+    finally:
+        store.close()
+
+def read_long(hdf5_fname,path,where=None,specs=None,start=None,stop=None,wide=True):
+    """
+    Reads a component written with write_long, widened to every column (or
+    those matching specs) for every row read.
+
+    wide: if False, return (cells, column_df) instead: cells has a row of
+        (column_code, value) per numeric and text cell read, indexed by
+        (id, datetime). Integer columns are 0 where they have no cell.
+    """
+    data_path,col_path = deconstucted_paths(path)
+    text_path = '{}/{}'.format(path,'text')
+    column_df = pd.read_hdf(hdf5_fname,col_path)
+    df_long = pd.read_hdf(hdf5_fname,data_path,where=where,start=start,stop=stop)
+    col_ix = None
+    if specs is not None: col_ix = column_df.index[complex_row_mask(column_df,specs).values]
+
+    df_text = None
+    dtypes = column_df['dtype'] if col_ix is None else column_df.loc[col_ix,'dtype']
+    if (dtypes == 'object').any() and not df_long.empty:
+        store = pd.HDFStore(hdf5_fname,mode='r')
+        try:
+            if text_path in store:
+                ids = df_long.index.get_level_values(column_names.ID)
+                where = '{id_col} >= {first} & {id_col} <= {last}'.format(id_col=column_names.ID,first=ids.min(),last=ids.max())
+                df_text = store.select(text_path,where=where)
+                # only the text of the rows read
+                df_text = df_text[df_text.index.isin(df_long.index)]
+        finally:
+            store.close()
+    if wide: return to_wide(df_long,column_df,df_text,col_ix)
+
+    codes = column_df.index if col_ix is None else col_ix
+    cells = [df_long[df_long[column_names.COLUMN_CODE].isin(codes)]]
+    if df_text is not None: cells.append(df_text[df_text[column_names.COLUMN_CODE].isin(codes)])
+    return pd.concat(cells),column_df
+
 def deconstucted_paths(path):
     data_path = '{}/{}'.format(path,'data')
     col_path = '{}/{}'.format(path,'columns')
@@ -227,7 +483,15 @@ def smart_join(hdf5_fname,paths,joined_path,ids,
                                         chunksize=5000,
                                         need_deconstruct=True,
                                         hdf5_fname_for_join=None,
-                                        overwrite=True):
+                                        overwrite=True,
+                                        n_threads=2,
+                                        prefetch=2):
+    """
+    Chunked outer join of the dataframes at paths, appended to joined_path.
+    A pool of n_threads reads the slices of up to prefetch chunks ahead while
+    the current chunk is joined and written. Slices are selected by id range
+    and then filtered to the chunk's ids.
+    """
 
     logger.log('Smart join: n={}, {}'.format(len(ids),paths),new_level=True)
 
@@ -240,48 +504,95 @@ def smart_join(hdf5_fname,paths,joined_path,ids,
             store.close()
             logger.end_log_level()
             return hdf5_fname_for_join
-    #sort ids, should speed up where clauses and selects
+    store.close()
+    #sort ids, so each chunk is a contiguous id range
     ids = sorted(ids)
+    id_slices = [ids[ix_start:ix_start + chunksize] for ix_start in range(0,len(ids),chunksize)]
 
     #do chunked join
     logger.log('JOINING dataframes',new_level=True)
-    for ix_start in range(0,len(ids),chunksize):
-        ix_end = min(ix_start + chunksize,len(ids))
-        id_slice = ids[ix_start:ix_end]
-
-        where = '{id_col} in {id_list}'.format(id_col=column_names.ID,id_list=id_slice)
-
-        logger.log('Slice & Join: {} --> {}, n={}'.format(id_slice[0], id_slice[-1],len(id_slice)),new_level=True)
-        df_slice = None
-        # for path in df_dict.keys():
-        for path in paths:
-            try:
-                logger.log(path)
-                if need_deconstruct: slice_to_add = read_and_reconstruct(hdf5_fname,path,where=where)
-                else: slice_to_add = pd.read_hdf(hdf5_fname,path,where=where)
-            except KeyError as err:
-                logger.log(end_prev=True,start=False)
-                print err
-                continue
-
-            if df_slice is None: df_slice = slice_to_add
-            else:
-                df_slice = df_slice.join(slice_to_add,how='outer')
-                del slice_to_add
-
-        logger.end_log_level()
-        logger.log('Append slice')
-
-        if need_deconstruct: deconstruct_and_write(df_slice,hdf5_fname_for_join,joined_path,append=True)
-        else: df_slice.to_hdf(hdf5_fname_for_join,joined_path,append=True,format='t')
-
-        del df_slice
+    pool = ThreadPool(n_threads)
+    try:
+        def read_slices(id_slice):
+            return [pool.apply_async(_read_id_slice,(hdf5_fname,path,id_slice,need_deconstruct)) for path in paths]
+
+        pending = deque()
+        for id_slice in id_slices:
+            pending.append((id_slice,read_slices(id_slice)))
+            if len(pending) <= prefetch: continue
+            _join_and_append(*pending.popleft(),paths=paths,pending=pending,
+                                hdf5_fname_for_join=hdf5_fname_for_join,joined_path=joined_path,
+                                need_deconstruct=need_deconstruct)
+        while len(pending) > 0:
+            _join_and_append(*pending.popleft(),paths=paths,pending=pending,
+                                hdf5_fname_for_join=hdf5_fname_for_join,joined_path=joined_path,
+                                need_deconstruct=need_deconstruct)
+    finally:
+        pool.terminate()
+        pool.join()
 
     logger.end_log_level()
     logger.end_log_level()
 
     return hdf5_fname_for_join
 
+def _join_and_append(id_slice,results,paths,pending,hdf5_fname_for_join,joined_path,need_deconstruct):
+    queue_depth = sum(all(result.ready() for result in chunk_results) for _,chunk_results in pending)
+    logger.log('Slice & Join: {} --> {}, n={}'.format(id_slice[0], id_slice[-1],len(id_slice)),new_level=True)
+
+    start = time.time()
+    slices = []
+    for path,result in zip(paths,results):
+        try:
+            slices.append(result.get())
+        except KeyError as err:
+            print err
+    read_wait = time.time() - start
+
+    start = time.time()
+    df_slice = None
+    for slice_to_add in slices:
+        if df_slice is None: df_slice = slice_to_add
+        else: df_slice = df_slice.join(slice_to_add,how='outer')
+    del slices
+    join_time = time.time() - start
+
+    start = time.time()
+    if df_slice is not None:
+        with _HDF5_LOCK:
+            if need_deconstruct: deconstruct_and_write(df_slice,hdf5_fname_for_join,joined_path,append=True)
+            else: df_slice.to_hdf(hdf5_fname_for_join,joined_path,append=True,format='t')
+    write_time = time.time() - start
+
+    n_rows = 0 if df_slice is None else len(df_slice)
+    total_time = read_wait + join_time + write_time
+    logger.log('rows={}, rows/s={:.0f}, read wait={:.2f}s, join={:.2f}s, write={:.2f}s, prefetched={}/{}'.format(
+                    n_rows,n_rows / max(total_time,1e-6),read_wait,join_time,write_time,queue_depth,len(pending)))
+    logger.end_log_level()
+
+def _read_id_slice(hdf5_fname,path,id_slice,need_deconstruct):
+    where = '{id_col} >= {first} & {id_col} <= {last}'.format(id_col=column_names.ID,first=id_slice[0],last=id_slice[-1])
+    #HDF5 isn't safe to use from several threads at once
+    with _HDF5_LOCK:
+        if need_deconstruct: df = read_and_reconstruct(hdf5_fname,path,where=where)
+        else: df = pd.read_hdf(hdf5_fname,path,where=where)
+    #ids between those of the chunk may be in the range
+    df = df[df.index.get_level_values(column_names.ID).isin(id_slice)]
+    return df
+
+def whole_id_chunks(chunks):
+    """
+    Re-chunks an iterable of dataframes sorted by id so that all rows for
+    a given id are in the same chunk
+    """
+    carry = None
+    for df in chunks:
+        if carry is not None: df = pd.concat([carry,df])
+        is_last_id = (df[column_names.ID] == df[column_names.ID].iloc[-1]).values
+        carry = df.loc[is_last_id]
+        if not is_last_id.all(): yield df.loc[~is_last_id]
+    if (carry is not None) and not carry.empty: yield carry
+
 def make_list_hash(l):
     #need to sort and make sure list are unique before hashing
     l = sorted(list(set(l)))
@@ -292,46 +603,85 @@ def make_list_hash(l):
     return key
 
 """
-Dask intelligent join
+Sort-merge join of components sorted on (id, datetime)
 """
 
 def dask_open_and_join(hdf5_fname,path,components,ids=ALL,chunksize=500000):
+    """
+    Outer join of the components under path on (id, datetime), see
+    merge_join_chunks. Only the joined frame and one chunk per component
+    are held in memory at a time.
+    """
+    logger.log('SORT-MERGE OPEN & JOIN n={} components: {}'.format(len(components),components),new_level=True)
+    paths = ['{}/{}'.format(path,component) for component in components]
+    chunks = list(merge_join_chunks(hdf5_fname,paths,ids,chunksize))
+
+    logger.log('Concat {} joined chunks'.format(len(chunks)))
+    if len(chunks) == 0: df_pd = pd.DataFrame()
+    else: df_pd = pd.concat(chunks)
+    del chunks
 
-    df_all=None
-    logger.log('DASK OPEN & JOIN n={} components: {}'.format(len(components),components),new_level=True)
-    for component in components:
-        logger.log('{}: {}/{}'.format(component.upper(),components.index(component)+1,len(components)),new_level=True)
-
-        df_comp = open_df(hdf5_fname,'{}/{}'.format(path,component))
-        df_comp.sort_index(inplace=True)
-        df_comp.sort_index(inplace=True, axis=1)
-
-        if not ids == ALL:
-            df_comp = df_comp[df_comp.index.get_level_values(column_names.ID).isin(ids)]
-
-        logger.log('Convert to dask - {}'.format(df_comp.shape))
-        df_dask = dd.from_pandas(df_comp.reset_index(), chunksize=chunksize)
-        del df_comp
-
-        logger.log('Join to big DF')
-
-        if df_all is None: df_all = df_dask
-        else :
-            df_all = df_all.merge(df_dask,how='outer', on=['id','datetime'])
-            del df_dask
-        logger.end_log_level()
-
-    logger.log('Dask DF back to pandas')
-    df_pd = df_all.compute()
-    del df_all
-    df_pd.set_index(['id','datetime'], inplace=True)
-
-    logger.log('SORT Joined DF')
-    df_pd.sort_index(inplace=True)
     df_pd.sort_index(inplace=True, axis=1)
     logger.end_log_level()
     return df_pd
 
+def merge_join_chunks(hdf5_fname,paths,ids=ALL,chunksize=500000):
+    """
+    Yields the outer join on (id, datetime) of the dataframes at paths, in
+    chunks of consecutive ids holding about chunksize rows in total. Every
+    component is read for the same id range, so each chunk is joined on
+    its own and nothing is shuffled.
+    """
+    store = pd.HDFStore(hdf5_fname,mode='r')
+    try:
+        id_counts = None
+        readers = []
+        for path in paths:
+            path_counts,read = _id_range_reader(store,path)
+            readers.append((path,read))
+            if id_counts is None: id_counts = path_counts
+            else: id_counts = id_counts.add(path_counts,fill_value=0)
+        if id_counts is None: return
+
+        if not ids == ALL: id_counts = id_counts[id_counts.index.isin(ids)]
+        id_counts.sort_index(inplace=True)
+        chunk_ix = (id_counts.cumsum().values - 1) // chunksize
+
+        for chunk_ids in np.split(id_counts.index.values,np.flatnonzero(np.diff(chunk_ix)) + 1):
+            if len(chunk_ids) == 0: continue
+            logger.log('Join: {} --> {}, n={}'.format(chunk_ids[0],chunk_ids[-1],len(chunk_ids)))
+            df_chunk = None
+            for path,read in readers:
+                df_comp = read(chunk_ids[0],chunk_ids[-1])
+                if not ids == ALL:
+                    df_comp = df_comp[df_comp.index.get_level_values(column_names.ID).isin(chunk_ids)]
+                if df_chunk is None: df_chunk = df_comp
+                else: df_chunk = df_chunk.join(df_comp,how='outer')
+                del df_comp
+            df_chunk.sort_index(inplace=True)
+            yield df_chunk
+    finally:
+        store.close()
+
+def _id_range_reader(store,path):
+    """
+    Returns the row count per id of the dataframe at path, and a function
+    reading its rows for ids first <= id <= last. Tables are read by range,
+    fixed format dataframes have to be loaded whole and are sliced.
+    """
+    if store.get_storer(path).is_table:
+        id_counts = pd.Series(store.select_column(path,column_names.ID)).value_counts()
+        def read(first,last):
+            where = '{id_col} >= {first} & {id_col} <= {last}'.format(id_col=column_names.ID,first=first,last=last)
+            return store.select(path,where=where)
+    else:
+        df = store[path]
+        df.sort_index(inplace=True)
+        id_counts = pd.Series(df.index.get_level_values(column_names.ID)).value_counts()
+        def read(first,last):
+            return df.loc[first:last]
+    return id_counts,read
+
 
 """
 Visualization